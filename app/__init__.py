@@ -13,6 +13,15 @@ from elasticsearch import Elasticsearch
 from config import Config
 from redis import Redis
 import rq
+from app.timeline import Timeline
+from app.suggestions import Suggestions
+from app.cache import RedisCache, TieredCache
+from app.last_seen import LastSeenBuffer
+from app.pubsub import NotificationBroker
+from app.search import create_backend
+from app.translate import Translator
+from app.language import LanguageDetector
+from app.passwords import PasswordHasher
 
 
 db = SQLAlchemy()
@@ -39,10 +48,28 @@ def create_app(config_class=Config):
     mail.init_app(app)
     bootstrap.init_app(app)
 
-    app.elasticsearch = None 
+    app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) \
+        if app.config['ELASTICSEARCH_URL'] else None
+    app.search = create_backend(app)
 
     app.redis = Redis.from_url(app.config['REDIS_URL'])
     app.task_queue = rq.Queue('microblog-tasks', connection=app.redis)
+    app.timeline = Timeline(app)
+    app.suggestions = Suggestions(app)
+    app.token_cache = RedisCache(app.redis, 'token', app.config['TOKEN_CACHE_SIZE'])
+    app.credential_cache = RedisCache(app.redis, 'credential', app.config['CREDENTIAL_CACHE_SIZE'],
+                                      app.config['CREDENTIAL_CACHE_TTL'])
+    app.password_hasher = PasswordHasher(app)
+    app.search_cache = RedisCache(app.redis, 'search', app.config['SEARCH_CACHE_SIZE'],
+                                  app.config['SEARCH_CACHE_TTL'])
+    app.translator = Translator(app)
+    app.language_detector = LanguageDetector(app)
+    from app.email import Mailer
+    app.mailer = Mailer(app)
+    app.translation_cache = TieredCache(app.redis, 'translation', app.config['TRANSLATION_CACHE_SIZE'],
+                                        app.config['TRANSLATION_CACHE_TTL'])
+    app.last_seen = LastSeenBuffer(app)
+    app.notifier = NotificationBroker(app)
     # blueprints register
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
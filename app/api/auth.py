@@ -1,8 +1,10 @@
-from flask import g
+from flask import g, abort, current_app
 from flask_httpauth import HTTPBasicAuth
-from app.models import User
+from app.models import User, token_digest
 from app.api.errors import error_response
+from app.passwords import PasswordHasherBusy
 from flask_httpauth import HTTPTokenAuth
+from werkzeug.local import LocalProxy
 
 
 token_auth = HTTPTokenAuth()
@@ -15,7 +17,10 @@ def verify_password(username, password):
     if user is None:
         return False
     g.current_user = user
-    return user.check_password(password)
+    try:
+        return user.check_password(password)
+    except PasswordHasherBusy as e:
+        abort(error_response(503, e.description))
 
 
 @basic_auth.error_handler
@@ -23,9 +28,20 @@ def basic_auth_error():
     return error_response(401)
 
 
+def load_token_user(token, user_id):
+    """加载令牌对应的用户；用户已被删除时清除令牌缓存并返回401"""
+    user = User.query.get(user_id)
+    if user is None:
+        current_app.token_cache.delete(token_digest(token))
+        abort(error_response(401))
+    return user
+
+
 @token_auth.verify_token
 def verify_token(token):
-    g.current_user = User.check_token(token) if token else None
+    user_id = User.check_token_id(token) if token else None
+    # 令牌命中缓存时不查询用户，视图首次使用g.current_user时才加载
+    g.current_user = LocalProxy(lambda: load_token_user(token, user_id)) if user_id is not None else None
     return g.current_user is not None
 
 
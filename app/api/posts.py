@@ -0,0 +1,100 @@
+from app.api import bp
+from flask import jsonify, request, url_for, g
+from app.models import Post, User
+from app.api.errors import bad_request
+from app import db
+from app.api.auth import token_auth
+
+
+def keyset_args():
+    return request.args.get('cursor', ''), min(request.args.get('per_page', 10, type=int), 100)
+
+
+def posts_response(query, endpoint, **kwargs):
+    """游标分页返回动态，只查询需要的列"""
+    cursor, per_page = keyset_args()
+    try:
+        data = Post.to_cursor_collection_dict(query, cursor, per_page, endpoint, **kwargs)
+    except ValueError:
+        return bad_request('invalid cursor')
+    return jsonify(data)
+
+
+def validate_body(data):
+    """检查动态内容，返回错误信息，没有错误时返回None"""
+    body = data.get('body') if isinstance(data, dict) else None
+    if not isinstance(body, str) or not body.strip():
+        return 'must include body field'
+    if len(body) > 140:
+        return 'body must be at most 140 characters'
+    return None
+
+
+@bp.route('/posts/<int:id>', methods=['GET'])
+@token_auth.login_required
+def get_post(id):
+    post = Post.api_query().filter(Post.id == id).first_or_404()
+    return jsonify(Post.to_dict_many([post])[0])
+
+
+@bp.route('/posts', methods=['GET'])
+@token_auth.login_required
+def get_posts():
+    return posts_response(Post.api_query(), 'api.get_posts')
+
+
+@bp.route('/users/<int:id>/posts', methods=['GET'])
+@token_auth.login_required
+def get_user_posts(id):
+    User.query.get_or_404(id)
+    return posts_response(Post.api_query().filter(Post.user_id == id), 'api.get_user_posts', id=id)
+
+
+@bp.route('/timeline', methods=['GET'])
+@token_auth.login_required
+def get_timeline():
+    """当前用户的首页动态，从时间线缓存读取"""
+    cursor, per_page = keyset_args()
+    try:
+        resources = g.current_user.timeline_keyset(cursor, per_page)
+    except ValueError:
+        return bad_request('invalid cursor')
+    return jsonify(Post.keyset_collection_dict(resources, cursor, per_page, 'api.get_timeline'))
+
+
+@bp.route('/posts', methods=['POST'])
+@token_auth.login_required
+def create_post():
+    data = request.get_json() or {}
+    error = validate_body(data)
+    if error:
+        return bad_request(error)
+    post = Post(body=data['body'], author=g.current_user)
+    db.session.add(post)
+    db.session.commit()
+    Post.schedule_language_detection([post.id])
+    response = jsonify(post.to_dict())
+    response.status_code = 201
+    response.headers['Location'] = url_for('api.get_post', id=post.id)
+    return response
+
+
+@bp.route('/posts/batch', methods=['POST'])
+@token_auth.login_required
+def create_posts():
+    """一次发表多条动态，{"posts": [{"body": ...}, ...]}，最多100条，在一个事务中完成"""
+    data = request.get_json() or {}
+    items = data.get('posts')
+    if not isinstance(items, list) or not 0 < len(items) <= 100:
+        return bad_request('posts must be a list of 1 to 100 posts')
+    for item in items:
+        error = validate_body(item)
+        if error:
+            return bad_request(error)
+    posts = [Post(body=item['body'], author=g.current_user) for item in items]
+    db.session.add_all(posts)
+    db.session.commit()
+    Post.schedule_language_detection([post.id for post in posts])
+    response = jsonify({'items': Post.to_dict_many(posts)})
+    response.status_code = 201
+    return response
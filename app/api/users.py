@@ -1,46 +1,100 @@
 from app.api import bp
-from flask import jsonify, request, url_for
+from flask import jsonify, request, url_for, g, current_app
 from app.models import User
-from app.api.errors import bad_request
+from app.api.errors import bad_request, error_response
 from app import db
 from app.api.auth import token_auth
+from app.pagination import cursor_arg
+
+
+def collection_response(query, endpoint, **kwargs):
+    """分页返回集合，传入cursor参数时使用游标分页；每个用户带上当前用户是否关注了他"""
+    page = request.args.get('page', 1, type=int)
+    per_page = min(request.args.get('per_page', 10, type=int), 100)
+    try:
+        data = User.to_collection_dict(query, page, per_page, endpoint, cursor=cursor_arg(),
+                                       options={'viewer': g.current_user}, **kwargs)
+    except ValueError:
+        return bad_request('invalid cursor')
+    return jsonify(data)
 
 
 @bp.route('/users/<int:id>', methods=['GET'])
 @token_auth.login_required
 def get_user(id):
-    return jsonify(User.query.get_or_404(id).to_dict())
+    user = User.query.get_or_404(id)
+    return jsonify(user.to_dict(is_following=g.current_user.is_following(user)))
+
+
+def ids_arg():
+    """请求中的用户id列表：JSON请求体中的ids数组，或查询参数ids=1,2,3；格式错误时返回None"""
+    data = request.get_json(silent=True) or {}
+    ids = data.get('ids') if 'ids' in data else request.args.get('ids', '').split(',')
+    try:
+        ids = list(dict.fromkeys(int(id) for id in ids if id != ''))
+    except (TypeError, ValueError):
+        return None
+    return ids if 0 < len(ids) <= 100 else None
+
+
+def users_by_ids(ids):
+    """一次查询取出ids对应的用户，按ids的顺序返回，不存在的id跳过"""
+    users = {user.id: user for user in User.query.filter(User.id.in_(ids))}
+    return [users[id] for id in ids if id in users]
 
 
 @bp.route('/users', methods=['GET'])
 @token_auth.login_required
 def get_users():
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 10, type=int), 100)
-    data = User.to_collection_dict(User.query, page, per_page, 'api.get_users')
-    return jsonify(data)
+    if 'ids' not in request.args:
+        return collection_response(User.query, 'api.get_users')
+    ids = ids_arg()
+    if ids is None:
+        return bad_request('ids must be a list of 1 to 100 user ids')
+    return jsonify({'items': User.to_dict_many(users_by_ids(ids), viewer=g.current_user)})
 
 
 @bp.route('/users/<int:id>/followers', methods=['GET'])
 @token_auth.login_required
 def get_followers(id):
     user = User.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 10, type=int), 100)
-    data = User.to_collection_dict(user.followers, page, per_page,
-                                   'api.get_followers', id=id)
-    return jsonify(data)
+    return collection_response(user.followers, 'api.get_followers', id=id)
 
 
 @bp.route('/users/<int:id>/followed', methods=['GET'])
 @token_auth.login_required
 def get_followed(id):
     user = User.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 10, type=int), 100)
-    data = User.to_collection_dict(user.followed, page, per_page,
-                                   'api.get_followed', id=id)
-    return jsonify(data)
+    return collection_response(user.followed, 'api.get_followed', id=id)
+
+
+@bp.route('/users/<int:id>/followed', methods=['POST', 'DELETE'])
+@token_auth.login_required
+def update_followed(id):
+    """批量关注(POST)或取消关注(DELETE)，{"ids": [...]}，在一个事务中完成"""
+    user = User.query.get_or_404(id)
+    if user.id != g.current_user.id:
+        return error_response(403)
+    ids = ids_arg()
+    if ids is None:
+        return bad_request('ids must be a list of 1 to 100 user ids')
+    users = users_by_ids(ids)
+    if len(users) != len(ids):
+        return bad_request('unknown user ids')
+    changed = user.follow_many(users) if request.method == 'POST' else user.unfollow_many(users)
+    db.session.commit()
+    return jsonify({'items': User.to_dict_many(changed, viewer=user)})
+
+
+@bp.route('/users/<int:id>/suggestions', methods=['GET'])
+@token_auth.login_required
+def get_suggestions(id):
+    """用户自己的推荐关注列表"""
+    user = User.query.get_or_404(id)
+    if user.id != g.current_user.id:
+        return error_response(403)
+    count = min(request.args.get('count', 10, type=int), current_app.config['SUGGESTIONS_SIZE'])
+    return jsonify({'items': User.to_dict_many(user.who_to_follow(count))})
 
 
 @bp.route('/users', methods=['POST'])
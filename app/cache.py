@@ -0,0 +1,131 @@
+import json
+import threading
+from collections import OrderedDict
+from time import time
+import redis
+
+
+def after_commit(session, func, *args):
+    """session提交后执行func(*args)，回滚则丢弃，用于保证缓存不先于数据库生效"""
+    session.info.setdefault('after_commit', []).append((func, args))
+
+
+def run_after_commit(session):
+    for func, args in session.info.pop('after_commit', []):
+        func(*args)
+
+
+def discard_after_commit(session, previous_transaction):
+    # 回滚savepoint时外层事务仍可能提交，保留待执行的操作
+    if not previous_transaction.nested:
+        session.info.pop('after_commit', None)
+
+
+class LRUCache:
+    """有容量上限的进程内缓存，条目可设置过期时间"""
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                return default
+            value, expires = item
+            if expires is not None and expires <= time():
+                del self.data[key]
+                return default
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl or self.ttl
+        with self.lock:
+            self.data[key] = (value, time() + ttl if ttl else None)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+
+class RedisCache:
+    """以JSON保存在Redis中的缓存，Redis不可用时退回到进程内LRU"""
+
+    def __init__(self, connection, prefix, maxsize=1024, ttl=None):
+        self.redis = connection
+        self.prefix = prefix
+        self.ttl = ttl
+        self.local = LRUCache(maxsize, ttl)
+
+    def key(self, key):
+        return f'{self.prefix}:{key}'
+
+    def get(self, key, default=None):
+        try:
+            value = self.redis.get(self.key(key))
+        except redis.exceptions.RedisError:
+            return self.local.get(key, default)
+        return json.loads(value) if value is not None else default
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl or self.ttl
+        try:
+            self.redis.set(self.key(key), json.dumps(value), ex=max(int(ttl), 1) if ttl else None)
+        except redis.exceptions.RedisError:
+            self.local.set(key, value, ttl)
+
+    def delete(self, key):
+        # Redis恢复前可能写入过本地缓存，两边都删除
+        self.local.delete(key)
+        try:
+            self.redis.delete(self.key(key))
+        except redis.exceptions.RedisError:
+            pass
+
+
+class TieredCache(RedisCache):
+    """进程内LRU在前、Redis在后的两级缓存，统计各级的命中和未命中次数"""
+
+    def __init__(self, connection, prefix, maxsize=1024, ttl=None):
+        super().__init__(connection, prefix, maxsize, ttl)
+        self.stats = {'local': 0, 'redis': 0, 'miss': 0}
+        self.lock = threading.Lock()
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def get(self, key, default=None):
+        value = self.local.get(key)
+        if value is not None:
+            self._count('local')
+            return value
+        try:
+            value = self.redis.get(self.key(key))
+        except redis.exceptions.RedisError:
+            value = None
+        if value is None:
+            self._count('miss')
+            return default
+        value = json.loads(value)
+        self.local.set(key, value)
+        self._count('redis')
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.local.set(key, value, ttl)
+        super().set(key, value, ttl)
@@ -1,4 +1,6 @@
 import os
+import json
+from time import time
 import click
 
 
@@ -33,3 +35,170 @@ def register(app):
         """Compile all languages."""
         if os.system('pybabel compile -d app/translations'):
             raise RuntimeError('compile command failed')
+
+    @app.cli.group()
+    def counters():
+        """Denormalized counter commands."""
+        pass
+
+    @counters.command()
+    def repair():
+        """Recompute post/follower/followed/unread message counts of all users."""
+        from app.models import User
+        fixed = User.repair_counters()
+        click.echo(f'{fixed} users repaired')
+
+    @app.cli.group()
+    def last_seen():
+        """User last-seen buffer commands."""
+        pass
+
+    @last_seen.command()
+    def flush():
+        """Write buffered last-seen times to the database."""
+        flushed = app.last_seen.flush()
+        click.echo(f'{flushed} users updated')
+
+    @app.cli.group()
+    def suggestions():
+        """Who-to-follow suggestion commands."""
+        pass
+
+    @suggestions.command()
+    def refresh():
+        """Recompute follow suggestions for all users."""
+        count = app.suggestions.refresh()
+        click.echo(f'{count} users refreshed')
+
+    @app.cli.group()
+    def exports():
+        """Post export file commands."""
+        pass
+
+    @exports.command()
+    def clean():
+        """Delete export files whose download links have expired."""
+        from app.models import User
+        removed = User.remove_expired_exports()
+        click.echo(f'{removed} files removed')
+
+    @app.cli.group()
+    def posts():
+        """Post maintenance commands."""
+        pass
+
+    @posts.command()
+    @click.option('--batch-size', default=500, help='Posts per batch.')
+    def detect_language(batch_size):
+        """Detect the language of posts that have none."""
+        from app.models import Post
+        from app import db
+        app.language_detector.warm()
+        last_id, total = 0, 0
+        while True:
+            ids = [id for id, in db.session.query(Post.id).filter(
+                Post.id > last_id, Post.language.is_(None)).order_by(Post.id).limit(batch_size)]
+            if not ids:
+                break
+            total += Post.detect_languages(ids)
+            last_id = ids[-1]
+            click.echo(f'{total} posts updated, last id {last_id}')
+        click.echo(f'{total} posts updated')
+
+    @app.cli.group('import')
+    def import_():
+        """Bulk import commands."""
+        pass
+
+    def import_options(f):
+        f = click.option('--workers', type=int, help='Password hashing processes.')(f)
+        f = click.option('--batch-size', default=1000, help='Records per transaction.')(f)
+        f = click.option('--format', type=click.Choice(['ndjson', 'csv']),
+                         help='Input format, guessed from the file extension by default.')(f)
+        return click.argument('file', type=click.File(encoding='utf-8'))(f)
+
+    def run_import(kind, file, format, batch_size, workers):
+        from app.importer import Importer, read_records
+        start = time()
+
+        def progress(imported, skipped):
+            click.echo(f'{imported} imported, {skipped} skipped, {imported / (time() - start):.0f}/s')
+
+        importer = Importer(batch_size, workers, progress)
+        getattr(importer, kind)(read_records(file, format))
+        click.echo(f'{importer.imported} {kind} imported, {importer.skipped} skipped in {time() - start:.1f}s')
+        return importer.imported
+
+    @import_.command('users')
+    @import_options
+    def import_users(file, format, batch_size, workers):
+        """Import users (username, email, password, about_me)."""
+        run_import('users', file, format, batch_size, workers)
+
+    @import_.command('posts')
+    @import_options
+    def import_posts(file, format, batch_size, workers):
+        """Import posts (author or author_id, body, time_stamp, language)."""
+        run_import('posts', file, format, batch_size, workers)
+
+    @import_.command('follows')
+    @import_options
+    def import_follows(file, format, batch_size, workers):
+        """Import follows (follower and followed usernames or ids)."""
+        if run_import('follows', file, format, batch_size, workers):
+            count = app.suggestions.refresh()
+            click.echo(f'{count} users refreshed')
+
+    @app.cli.group()
+    def search():
+        """Search index commands."""
+        pass
+
+    @search.command()
+    def drain():
+        """Send pending outbox changes to the search engine."""
+        from app.models import SearchOutbox
+        total = SearchOutbox.drain_all(app.config['SEARCH_INDEX_BATCH_SIZE'])
+        click.echo(f'{total} changes indexed')
+
+    @search.command()
+    def status():
+        """Show the search outbox backlog and lag."""
+        from app.models import SearchOutbox
+        backlog = SearchOutbox.backlog()
+        click.echo(f'{backlog["pending"]} pending, lag {backlog["lag"]:.1f}s')
+
+    @search.command()
+    @click.argument('index', default='post')
+    @click.option('--workers', default=4, help='Number of concurrent bulk requests.')
+    @click.option('--chunk-size', type=int, help='Documents per bulk request.')
+    @click.option('--resume', is_flag=True, help='Continue from the last checkpoint.')
+    def reindex(index, workers, chunk_size, resume):
+        """Rebuild a search index into a new index, then switch the alias."""
+        from app.models import SearchableMixin
+        from app.search import switch_index
+        models = SearchableMixin.searchable_models()
+        if index not in models:
+            raise click.BadParameter(f'choose from {", ".join(models)}', param_hint='index')
+        model = models[index]
+        checkpoint = f'reindex-{index}.json'
+        if resume and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                state = json.load(f)
+        else:
+            state = {'target': app.search.create_index(index, model.__searchable__), 'last_id': 0}
+        total = model.query.filter(model.id > state['last_id']).count()
+        click.echo(f'indexing {total} documents into {state["target"]} after id {state["last_id"]}')
+        start = time()
+
+        def progress(last_id, done):
+            state['last_id'] = last_id
+            with open(checkpoint, 'w') as f:
+                json.dump(state, f)
+            click.echo(f'{done}/{total} documents, last id {last_id}, {done / (time() - start):.0f}/s')
+
+        done = model.reindex(state['target'], state['last_id'], chunk_size, workers, progress)
+        switch_index(index, state['target'])
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        click.echo(f'{done} documents indexed in {time() - start:.1f}s, {index} -> {state["target"]}')
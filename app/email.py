@@ -1,12 +1,112 @@
-from threading import Thread
+import queue
+import smtplib
+import threading
+from time import time, sleep
 from flask import current_app
 from flask_mail import Message
 from app import mail
 
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+class Mailer:
+    """后台发送邮件：有界队列加一个发送线程
+
+    发送线程每次取出一批邮件，共用一个SMTP连接发送，按MAIL_RATE_LIMIT限制每秒发送的封数，
+    失败的邮件重新连接后按指数退避重试，超过MAIL_MAX_RETRIES次后放弃并记录日志。
+    """
+
+    def __init__(self, app=None):
+        self.thread = None
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.queue = queue.Queue(app.config['MAIL_QUEUE_SIZE'])
+        self.batch_size = app.config['MAIL_BATCH_SIZE']
+        self.interval = 1 / app.config['MAIL_RATE_LIMIT']
+        self.max_retries = app.config['MAIL_MAX_RETRIES']
+        self.backoff = app.config['MAIL_RETRY_BACKOFF']
+        self.last_sent = 0
+
+    def send(self, msg, timeout=5):
+        """放入发送队列，队列满时最多等待timeout秒，仍然放不下则丢弃并返回False"""
+        self._start()
+        try:
+            self.queue.put(msg, timeout=timeout)
+        except queue.Full:
+            self.app.logger.error('Mail queue is full, dropping message to %s', msg.recipients)
+            return False
+        return True
+
+    def join(self):
+        """等待队列中的邮件全部处理完"""
+        self.queue.join()
+
+    def _start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        with self.app.app_context():
+            while True:
+                batch = [self.queue.get()]
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                try:
+                    self._send_batch(batch)
+                except Exception:
+                    # 不能让发送线程退出，否则之后的邮件都不会发出
+                    self.app.logger.exception('Failed to send mail batch')
+                finally:
+                    for _ in batch:
+                        self.queue.task_done()
+
+    def _send_batch(self, batch):
+        pending = [(msg, 0) for msg in batch]
+        while pending:
+            failed = []
+            remaining = list(pending)
+            try:
+                with mail.connect() as connection:
+                    while remaining:
+                        msg, attempts = remaining[0]
+                        self._throttle()
+                        try:
+                            connection.send(msg)
+                        except smtplib.SMTPServerDisconnected:
+                            raise
+                        except smtplib.SMTPException as e:
+                            # 单封邮件被拒绝，连接仍可继续使用
+                            failed.append((msg, attempts, e))
+                        except OSError:
+                            raise
+                        except Exception:
+                            # 邮件本身有问题(例如BadHeaderError)，重试也不会成功，记录后丢弃
+                            self.app.logger.exception('Failed to send mail to %s', msg.recipients)
+                        remaining.pop(0)
+            except (smtplib.SMTPException, OSError) as e:
+                # 连接失败或断开，还没发出的邮件重新连接后再发
+                failed.extend((msg, attempts, e) for msg, attempts in remaining)
+            pending = []
+            for msg, attempts, error in failed:
+                if attempts + 1 >= self.max_retries:
+                    self.app.logger.error('Failed to send mail to %s: %s', msg.recipients, error)
+                else:
+                    pending.append((msg, attempts + 1))
+            if pending:
+                sleep(self.backoff * 2 ** (pending[0][1] - 1))
+
+    def _throttle(self):
+        wait = self.last_sent + self.interval - time()
+        if wait > 0:
+            sleep(wait)
+        self.last_sent = time()
 
 
 def send_email(subject, sender, recipients, text_body, html_body,
@@ -20,5 +120,4 @@ def send_email(subject, sender, recipients, text_body, html_body,
     if sync:
         mail.send(msg)
     else:
-        Thread(target=send_async_email,
-               args=(current_app._get_current_object(), msg)).start()
+        current_app.mailer.send(msg)
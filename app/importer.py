@@ -0,0 +1,230 @@
+import csv
+import json
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from itertools import islice, repeat
+from time import time
+from werkzeug.security import generate_password_hash
+from flask import current_app
+from app import db
+from app.models import User, Post, SearchOutbox, followers
+
+
+def read_records(file, format=None):
+    """逐条读取NDJSON或CSV(首行为列名)，format为空时按扩展名判断；无法解析的行返回None"""
+    format = format or ('csv' if file.name.endswith('.csv') else 'ndjson')
+    if format == 'csv':
+        yield from csv.DictReader(file)
+        return
+    for line in file:
+        line = line.strip()
+        if line:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+
+
+def chunks(records, size):
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def hash_password(password, method):
+    """在子进程中执行，需要是模块级函数"""
+    return generate_password_hash(password, method) if password else None
+
+
+def text(record, field):
+    value = record.get(field)
+    return str(value).strip() if value is not None else ''
+
+
+def utc_datetime(value):
+    """解析ISO格式时间，带时区的转换为UTC，不带时区的视为UTC；返回不带时区的datetime"""
+    value = datetime.fromisoformat(value[:-1] + '+00:00' if value.endswith('Z') else value)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def integer(record, field):
+    try:
+        return int(record.get(field) or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+class Importer:
+    """批量导入用户、post和关注关系
+
+    记录分块处理，每块用一次查询检查唯一性或查出用户id，用executemany写入并单独提交。
+    导入用户时密码在进程池中计算，与上一块的写入并行。绕过ORM写入，
+    冗余计数、搜索outbox和时间线缓存由这里直接维护。无效或重复的记录跳过并计数。
+    """
+
+    def __init__(self, batch_size=1000, workers=None, on_progress=None):
+        self.batch_size = batch_size
+        self.workers = workers
+        self.on_progress = on_progress
+        self.imported = 0
+        self.skipped = 0
+
+    def _progress(self, imported, skipped):
+        self.imported += imported
+        self.skipped += skipped
+        if self.on_progress:
+            self.on_progress(self.imported, self.skipped)
+
+    def users(self, records):
+        """字段：username、email，可选password、about_me"""
+        seen_usernames, seen_emails = set(), set()
+        method = current_app.config['PASSWORD_HASH_METHOD']
+        pending = None
+        with ProcessPoolExecutor(self.workers) as executor:
+            for chunk in chunks(records, self.batch_size):
+                rows = self._user_rows(chunk, seen_usernames, seen_emails)
+                chunksize = max(1, len(rows) // ((self.workers or 1) * 4))
+                hashes = executor.map(hash_password, [row.pop('password') for row in rows],
+                                      repeat(method), chunksize=chunksize)
+                if pending:
+                    self._write_users(*pending)
+                pending = (rows, hashes, len(chunk) - len(rows))
+            if pending:
+                self._write_users(*pending)
+
+    def _user_rows(self, chunk, seen_usernames, seen_emails):
+        rows = []
+        for record in chunk:
+            if not isinstance(record, dict):
+                continue
+            username, email = text(record, 'username'), text(record, 'email')
+            if not username or not email or len(username) > 64 or len(email) > 120 or \
+                    username in seen_usernames or email in seen_emails:
+                continue
+            seen_usernames.add(username)
+            seen_emails.add(email)
+            rows.append({'username': username, 'email': email,
+                         'about_me': text(record, 'about_me')[:140] or None,
+                         'password': record.get('password') or None})
+        if not rows:
+            return rows
+        taken_usernames, taken_emails = set(), set()
+        for username, email in db.session.query(User.username, User.email).filter(db.or_(
+                User.username.in_([row['username'] for row in rows]),
+                User.email.in_([row['email'] for row in rows]))):
+            taken_usernames.add(username)
+            taken_emails.add(email)
+        return [row for row in rows
+                if row['username'] not in taken_usernames and row['email'] not in taken_emails]
+
+    def _write_users(self, rows, hashes, skipped):
+        for row, password_hash in zip(rows, hashes):
+            row['password_hash'] = password_hash
+        if rows:
+            db.session.execute(User.__table__.insert(), rows)
+            db.session.commit()
+        self._progress(len(rows), skipped)
+
+    @staticmethod
+    def _user_ids(chunk, fields):
+        """一次查询解析记录中的用户，字段为用户名(如author)或id(如author_id)，返回{用户名或id: id}"""
+        usernames, ids = set(), set()
+        for record in chunk:
+            if isinstance(record, dict):
+                for field in fields:
+                    usernames.add(text(record, field))
+                    ids.add(integer(record, f'{field}_id'))
+        usernames.discard('')
+        ids.discard(0)
+        if not usernames and not ids:
+            return {}
+        found = {}
+        for id, username in db.session.query(User.id, User.username).filter(
+                db.or_(User.username.in_(usernames), User.id.in_(ids))):
+            found[username] = found[id] = id
+        return found
+
+    @staticmethod
+    def _resolve(record, field, found):
+        return found.get(text(record, field)) or found.get(integer(record, f'{field}_id'))
+
+    @staticmethod
+    def _add_counts(name, counts):
+        if counts:
+            user = User.__table__
+            db.session.execute(user.update().where(user.c.id == db.bindparam('counted_id'))
+                               .values({name: user.c[name] + db.bindparam('delta')}),
+                               [{'counted_id': id, 'delta': delta} for id, delta in counts.items()])
+
+    @staticmethod
+    def _follower_ids(user_ids):
+        return {id for id, in db.session.query(followers.c.follower_id).filter(
+            followers.c.followed_id.in_(user_ids))}
+
+    def posts(self, records):
+        """字段：author(用户名)或author_id、body，可选time_stamp(ISO格式)、language"""
+        for chunk in chunks(records, self.batch_size):
+            found = self._user_ids(chunk, ['author'])
+            rows = []
+            for record in chunk:
+                if not isinstance(record, dict):
+                    continue
+                user_id, body = self._resolve(record, 'author', found), text(record, 'body')
+                try:
+                    time_stamp = utc_datetime(text(record, 'time_stamp')) \
+                        if record.get('time_stamp') else datetime.utcnow()
+                except ValueError:
+                    continue
+                if user_id is None or not body or len(body) > 140:
+                    continue
+                rows.append({'user_id': user_id, 'body': body, 'time_stamp': time_stamp,
+                             'language': text(record, 'language')[:5] or None})
+            if rows:
+                self._write_posts(rows)
+            self._progress(len(rows), len(chunk) - len(rows))
+
+    def _write_posts(self, rows):
+        # 批量插入拿不到各行的id，插入后按id范围查出，期间其他人发表的post多索引一次也没有关系
+        last_id = db.session.query(db.func.max(Post.id)).scalar() or 0
+        db.session.execute(Post.__table__.insert(), rows)
+        ids = [id for id, in db.session.query(Post.id).filter(Post.id > last_id)]
+        now = time()
+        db.session.execute(SearchOutbox.__table__.insert(), [
+            {'index': Post.__tablename__, 'object_id': id, 'operation': 'add', 'time_stamp': now}
+            for id in ids])
+        authors = Counter(row['user_id'] for row in rows)
+        self._add_counts('post_count', authors)
+        follower_ids = self._follower_ids(list(authors))
+        db.session.commit()
+        if not SearchOutbox.schedule():
+            SearchOutbox.drain_inline(len(ids))
+        current_app.timeline.discard(set(authors) | follower_ids)
+        if any(row['language'] is None for row in rows):
+            Post.schedule_language_detection(ids)
+
+    def follows(self, records):
+        """字段：follower、followed(用户名)或follower_id、followed_id"""
+        for chunk in chunks(records, self.batch_size):
+            found = self._user_ids(chunk, ['follower', 'followed'])
+            pairs = dict.fromkeys(
+                (self._resolve(record, 'follower', found), self._resolve(record, 'followed', found))
+                for record in chunk if isinstance(record, dict))
+            pairs = [(a, b) for a, b in pairs if a is not None and b is not None and a != b]
+            if pairs:
+                existing = set(db.session.query(followers.c.follower_id, followers.c.followed_id).filter(
+                    followers.c.follower_id.in_({a for a, _ in pairs}),
+                    followers.c.followed_id.in_({b for _, b in pairs})))
+                pairs = [pair for pair in pairs if pair not in existing]
+            if pairs:
+                db.session.execute(followers.insert(), [{'follower_id': a, 'followed_id': b} for a, b in pairs])
+                self._add_counts('followed_count', Counter(a for a, _ in pairs))
+                self._add_counts('follower_count', Counter(b for _, b in pairs))
+                db.session.commit()
+                current_app.timeline.discard({a for a, _ in pairs})
+            self._progress(len(pairs), len(chunk) - len(pairs))
@@ -0,0 +1,39 @@
+import threading
+from langdetect.detector_factory import DetectorFactory, PROFILES_DIRECTORY
+from langdetect.lang_detect_exception import LangDetectException
+
+
+class LanguageDetector:
+    """语言识别，语言模型只加载一次并固定随机种子，同一段文本总是得到相同结果
+
+    加载模型较慢，web进程在第一次使用时加载，RQ worker启动时预先加载。
+    """
+
+    def __init__(self, app=None):
+        self.factory = None
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.min_length = app.config['LANGUAGE_DETECTION_MIN_LENGTH']
+
+    def warm(self):
+        with self.lock:
+            if self.factory is None:
+                factory = DetectorFactory()
+                factory.load_profile(PROFILES_DIRECTORY)
+                factory.set_seed(0)
+                self.factory = factory
+        return self.factory
+
+    def detect(self, text):
+        """返回两个字母的语言代码，文本太短或无法识别时返回空字符串"""
+        if len(text) < self.min_length:
+            return ''
+        detector = self.warm().create()
+        detector.append(text)
+        try:
+            return detector.detect()[:2]  # 中文识别为zh
+        except LangDetectException:
+            return ''
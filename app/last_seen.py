@@ -0,0 +1,77 @@
+import threading
+from datetime import datetime
+from time import time
+import redis
+from app.cache import LRUCache
+
+
+class LastSeenBuffer:
+    """合并用户最后访问时间的写入
+
+    每次请求只记录到缓冲区(Redis哈希，Redis不可用时为进程内字典)，
+    同一用户在间隔内的重复访问直接跳过，按间隔批量UPDATE到user表。
+    """
+
+    key = 'last_seen:pending'
+
+    def __init__(self, app=None):
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.last_flush = time()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.redis = app.redis
+        self.interval = app.config['LAST_SEEN_INTERVAL']
+        self.recent = LRUCache(app.config['LAST_SEEN_BUFFER_SIZE'], ttl=self.interval)
+
+    def touch(self, user_id, when=None):
+        """记录用户的访问时间，间隔内已记录过则跳过"""
+        if self.recent.get(user_id):
+            return False
+        self.recent.set(user_id, True)
+        when = when or datetime.utcnow()
+        try:
+            self.redis.hset(self.key, user_id, when.isoformat())
+        except redis.exceptions.RedisError:
+            with self.lock:
+                self.pending[user_id] = when
+        return True
+
+    def _drain(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        try:
+            pipe = self.redis.pipeline()
+            pipe.hgetall(self.key)
+            pipe.delete(self.key)
+            stored, _ = pipe.execute()
+        except redis.exceptions.RedisError:
+            return pending
+        for user_id, when in stored.items():
+            user_id, when = int(user_id), datetime.fromisoformat(when.decode('utf-8'))
+            if user_id not in pending or pending[user_id] < when:
+                pending[user_id] = when
+        return pending
+
+    def flush(self):
+        """把缓冲区写入数据库，返回更新的用户数"""
+        from app import db
+        from app.models import User
+        self.last_flush = time()
+        pending = self._drain()
+        if pending:
+            user = User.__table__
+            db.session.execute(
+                user.update().where(user.c.id == db.bindparam('user_id'))
+                .values(last_seen=db.bindparam('when')),
+                [{'user_id': user_id, 'when': when} for user_id, when in pending.items()])
+            db.session.commit()
+        return len(pending)
+
+    def maybe_flush(self):
+        """距上次写入超过间隔时写入数据库"""
+        if time() - self.last_flush >= self.interval:
+            return self.flush()
+        return 0
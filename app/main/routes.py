@@ -1,21 +1,43 @@
-from flask import render_template, flash, redirect, url_for, request, g, jsonify, current_app
+from flask import render_template, flash, redirect, url_for, request, g, jsonify, current_app, abort, \
+    Response, send_file
 from app import db
 from app.main.forms import EditProfileForm, PostForm, SearchForm, MessageForm
 from flask_login import current_user, login_required
 from app.models import User, Post, Message, Notification
-from datetime import datetime
+from time import time
+import json
+import os
+import redis
 from flask_babel import _, get_locale
-from langdetect import detect
-from app.translate import translate
+from app.translate import translate, translate_many
 from app.main import bp
+from app.pagination import cursor_arg, keyset_paginate
+
+
+def keyset_or_400(func, *args, **kwargs):
+    """执行游标分页，游标无效时返回400"""
+    try:
+        return func(*args, **kwargs)
+    except ValueError:
+        abort(400)
+
+
+def keyset_urls(endpoint, resources, **kwargs):
+    """游标分页的上一页/下一页链接"""
+    next_url = url_for(endpoint, cursor=resources.next_cursor, **kwargs) \
+        if resources.has_next else None
+    prev_url = url_for(endpoint, cursor=resources.prev_cursor, **kwargs) \
+        if resources.has_prev else None
+    return next_url, prev_url
 
 
 @bp.before_request
 def before_request():
     """记录用户每次最后的访问时间"""
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        # 写入缓冲区，按LAST_SEEN_INTERVAL批量更新到数据库
+        current_app.last_seen.touch(current_user.id)
+        current_app.last_seen.maybe_flush()
         g.search_form = SearchForm()
     # 返回给定请求的语言和语言环境,并添加到g对象
     lang = str(get_locale())
@@ -29,20 +51,24 @@ def index():
     """首页"""
     form = PostForm()
     if form.validate_on_submit():
-        language = detect(form.post.data)[:2]  # 中文识别为zh
-        if len(form.post.data) < 8:
-            language = ''
-        post = Post(body=form.post.data, author=current_user, language=language)
+        post = Post(body=form.post.data, author=current_user)
         db.session.add(post)
         db.session.commit()
+        Post.schedule_language_detection([post.id])
         flash(_('Your post is now live!'))
         return redirect(url_for('main.index'))
+    cursor = cursor_arg()
+    if cursor is not None:
+        posts = keyset_or_400(current_user.timeline_keyset, cursor,
+                              current_app.config['POSTS_PER_PAGE'])
+        next_url, prev_url = keyset_urls('main.index', posts)
+        return render_template('index.html', title=_('Home Page'), posts=posts.items, form=form,
+                               next_url=next_url, prev_url=prev_url)
     page = request.args.get('page', 1, type=int)
-    posts = current_user.followed_posts().paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.index', page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.index', page=posts.prev_num) if posts.has_prev else None
-    return render_template('index.html', title=_('Home Page'), posts=posts.items, form=form,
+    posts, has_next = current_user.timeline(page, current_app.config['POSTS_PER_PAGE'])
+    next_url = url_for('main.index', page=page + 1) if has_next else None
+    prev_url = url_for('main.index', page=page - 1) if page > 1 else None
+    return render_template('index.html', title=_('Home Page'), posts=posts, form=form,
                            next_url=next_url, prev_url=prev_url)
 
 
@@ -51,6 +77,13 @@ def index():
 def user(username):
     """个人主页"""
     user = User.query.filter_by(username=username).first_or_404()
+    cursor = cursor_arg()
+    if cursor is not None:
+        posts = keyset_or_400(keyset_paginate, user.posts, (Post.time_stamp, Post.id), cursor,
+                              current_app.config['POSTS_PER_PAGE'])
+        next_url, prev_url = keyset_urls('main.user', posts, username=user.username)
+        return render_template('user.html', user=user, posts=posts.items, next_url=next_url,
+                               prev_url=prev_url)
     page = request.args.get('page', 1, type=int)
     posts = user.posts.order_by(Post.time_stamp.desc()).paginate(page, current_app.config['POSTS_PER_PAGE'], False)
     next_url = url_for('main.user', username=user.username, page=posts.next_num) \
@@ -117,6 +150,13 @@ def unfollow(username):
 @login_required
 def explore():
     """展示最新的post"""
+    cursor = cursor_arg()
+    if cursor is not None:
+        posts = keyset_or_400(keyset_paginate, Post.query, (Post.time_stamp, Post.id), cursor,
+                              current_app.config['POSTS_PER_PAGE'])
+        next_url, prev_url = keyset_urls('main.explore', posts)
+        return render_template('index.html', title=_('Explore'), posts=posts.items,
+                               next_url=next_url, prev_url=prev_url)
     page = request.args.get('page', 1, type=int)
     posts = Post.query.order_by(Post.time_stamp.desc()).paginate(
         page, current_app.config['POSTS_PER_PAGE'], False
@@ -137,6 +177,24 @@ def translate_text():
         request.form['dest_language'][:2])})  # zh-CN
 
 
+@bp.route('/translate/batch', methods=['POST'])
+@login_required
+def translate_batch():
+    """批量翻译动态，请求体为{"items": [{"post_id": 1, "dest_language": "en"}, ...]}"""
+    items = (request.get_json(silent=True) or {}).get('items')
+    if not isinstance(items, list) or len(items) > current_app.config['POSTS_PER_PAGE'] * 5:
+        abort(400)
+    try:
+        items = [(int(item['post_id']), str(item['dest_language'])[:2]) for item in items]
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+    posts = {post.id: post for post in Post.query.filter(Post.id.in_({post_id for post_id, _ in items}))}
+    items = [(posts[post_id], dest) for post_id, dest in items if post_id in posts]
+    texts = translate_many([(post.body, post.language, dest) for post, dest in items])
+    return jsonify({'translations': [{'post_id': post.id, 'dest_language': dest, 'text': text}
+                                     for (post, dest), text in zip(items, texts)]})
+
+
 @bp.route('/search')
 @login_required
 def search():
@@ -169,7 +227,7 @@ def send_message(recipient):
     if form.validate_on_submit():
         msg = Message(author=current_user, recipient=user, body=form.message.data)
         db.session.add(msg)
-        user.add_notification('unread_message_count', user.new_messages())
+        user.add_notification('unread_message_count', user.add_unread_message())
         db.session.commit()
         flash(_('Your Message has been sent.'))
         return redirect(url_for('main.user', username=recipient))
@@ -180,9 +238,16 @@ def send_message(recipient):
 @bp.route('/messages')
 @login_required
 def messages():
-    current_user.last_message_read_time = datetime.utcnow()
-    current_user.add_notification('unread_message_count', 0)
+    current_user.read_messages()
     db.session.commit()
+    cursor = cursor_arg()
+    if cursor is not None:
+        messages = keyset_or_400(keyset_paginate, current_user.messages_received,
+                                 (Message.time_stamp, Message.id), cursor,
+                                 current_app.config['POSTS_PER_PAGE'])
+        next_url, prev_url = keyset_urls('main.messages', messages)
+        return render_template('messages.html', messages=messages.items,
+                               title=_('Messages'), next_url=next_url, prev_url=prev_url)
     page = request.args.get('page', 1, type=int)
     messages = current_user.messages_received.order_by(
         Message.time_stamp.desc()).paginate(
@@ -202,16 +267,45 @@ def notifications():
     since = request.args.get('since', 0, type=int)
     notifications = current_user.notifications.filter(
         Notification.time_stamp > since).order_by(Notification.time_stamp.asc())
-    return jsonify([{
-        'name': n.name,
-        'data': n.get_data(),
-        'time_stamp': int(n.time_stamp)
-    }for n in notifications])
+    return jsonify([n.to_dict() for n in notifications])
     # return jsonify(
     #     {'data': current_user.new_messages()}
     # )
 
 
+@bp.route('/notifications/stream')
+@login_required
+def notification_stream():
+    """以Server-Sent Events推送通知，连接超时后由浏览器自动重连"""
+    since = request.headers.get('Last-Event-ID', type=int) or request.args.get('since', 0, type=int)
+    subscription = current_app.notifier.subscribe(current_user.id)
+    # 先订阅再补发错过的通知，避免遗漏
+    backlog = [n.to_dict() for n in current_user.notifications.filter(
+        Notification.time_stamp > since).order_by(Notification.time_stamp.asc())]
+    db.session.remove()
+    timeout = current_app.config['NOTIFICATION_STREAM_TIMEOUT']
+    heartbeat = current_app.config['NOTIFICATION_STREAM_HEARTBEAT']
+
+    def event_stream():
+        try:
+            for n in backlog:
+                yield f'id: {n["time_stamp"]}\ndata: {json.dumps(n)}\n\n'
+            deadline = time() + timeout
+            while time() < deadline:
+                n = subscription.get(timeout=min(heartbeat, max(deadline - time(), 0)))
+                if n is None:
+                    yield ': keepalive\n\n'
+                else:
+                    yield f'id: {n["time_stamp"]}\ndata: {json.dumps(n)}\n\n'
+        except redis.exceptions.RedisError:
+            pass
+        finally:
+            subscription.close()
+
+    return Response(event_stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @bp.route('/export_posts')
 @login_required
 def export_posts():
@@ -221,3 +315,17 @@ def export_posts():
         current_user.launch_task('export_posts', _('Exporting posts...'))
         db.session.commit()
     return redirect(url_for('main.user', username=current_user.username))
+
+
+@bp.route('/export_posts/<token>')
+@login_required
+def download_export(token):
+    """下载导出的post，令牌必须属于当前用户"""
+    filename = current_user.verify_export_token(token)
+    if filename is None:
+        abort(404)
+    path = os.path.join(current_app.config['EXPORT_FOLDER'], os.path.basename(filename))
+    if not os.path.exists(path):
+        abort(404)
+    return send_file(path, mimetype='application/gzip', as_attachment=True,
+                     download_name='posts.ndjson.gz')
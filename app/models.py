@@ -1,11 +1,12 @@
 from app import db
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
 from app import login
-from hashlib import md5
+from hashlib import md5, sha256
 import jwt
 from flask import current_app
 from app.search import add_to_index, remove_from_index, query_index
+from app.cache import after_commit, run_after_commit, discard_after_commit
+from app.pagination import keyset_paginate
 import json
 from time import time
 import rq
@@ -14,19 +15,51 @@ from flask import url_for
 import base64
 import os
 from datetime import datetime, timedelta
+from sqlalchemy.sql.expression import ClauseElement
+from functools import lru_cache
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 
+# 生成链接模板时代替真实id的占位值
+LINK_ID_PLACEHOLDER = 2 ** 53
+
+
+@lru_cache(maxsize=10000)
+def email_digest(email):
+    return md5(email.lower().encode('utf-8')).hexdigest()
+
+
+def token_digest(token):
+    """令牌缓存的键，不直接保存令牌"""
+    return sha256(token.encode('utf-8')).hexdigest()
+
+
+# (follower_id, followed_id)主键同时是判断关注关系的索引，followed_id上的索引用于查粉丝
 followers = db.Table('followers',
-                     db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-                     db.Column('followed_id', db.Integer, db.ForeignKey('user.id')))
+                     db.Column('follower_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+                     db.Column('followed_id', db.Integer, db.ForeignKey('user.id'), primary_key=True,
+                               index=True))
 
 
 class PaginatedAPIMixin:
-    @staticmethod
-    def to_collection_dict(query, page, per_page, endpoint, **kwargs):
+    # 游标分页的排序键，需唯一确定一行
+    __keyset__ = ('id',)
+    __keyset_descending__ = False
+
+    @classmethod
+    def to_dict_many(cls, items):
+        """序列化一页数据，子类可覆盖以避免逐行查询"""
+        return [item.to_dict() for item in items]
+
+    @classmethod
+    def to_collection_dict(cls, query, page, per_page, endpoint, cursor=None, options=None, **kwargs):
+        """options为传给to_dict_many的参数，其余kwargs用于生成链接"""
+        if cursor is not None:
+            return cls.to_cursor_collection_dict(query, cursor, per_page, endpoint, options, **kwargs)
         resources = query.paginate(page, per_page, False)
         data = {
-            'items': [item.to_dict() for item in resources.items],
+            'items': cls.to_dict_many(resources.items, **(options or {})),
             '_meta': {
                 'page': page,
                 'per_page': per_page,
@@ -44,6 +77,32 @@ class PaginatedAPIMixin:
         }
         return data
 
+    @classmethod
+    def to_cursor_collection_dict(cls, query, cursor, per_page, endpoint, options=None, **kwargs):
+        """游标分页，不返回总数；游标无效时抛出ValueError"""
+        columns = [getattr(cls, name) for name in cls.__keyset__]
+        resources = keyset_paginate(query, columns, cursor, per_page, cls.__keyset_descending__)
+        return cls.keyset_collection_dict(resources, cursor, per_page, endpoint, options, **kwargs)
+
+    @classmethod
+    def keyset_collection_dict(cls, resources, cursor, per_page, endpoint, options=None, **kwargs):
+        """把已经取出的一页KeysetPagination序列化为集合"""
+        data = {
+            'items': cls.to_dict_many(resources.items, **(options or {})),
+            '_meta': {
+                'cursor': cursor,
+                'per_page': per_page
+            },
+            '_links': {
+                'self': url_for(endpoint, cursor=cursor, per_page=per_page, **kwargs),
+                'next': url_for(endpoint, cursor=resources.next_cursor, per_page=per_page,
+                                **kwargs) if resources.has_next else None,
+                'prev': url_for(endpoint, cursor=resources.prev_cursor, per_page=per_page,
+                                **kwargs) if resources.has_prev else None,
+            }
+        }
+        return data
+
 
 class User(PaginatedAPIMixin, UserMixin, db.Model):
     """用户表"""
@@ -73,38 +132,136 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
 
     tasks = db.relationship('Task', backref='user', lazy='dynamic')
 
+    # 冗余计数，由follow/unfollow、post的增删和私信收发维护，可用flask counters repair修复
+    post_count = db.Column(db.Integer, default=0, server_default='0')
+    follower_count = db.Column(db.Integer, default=0, server_default='0')
+    followed_count = db.Column(db.Integer, default=0, server_default='0')
+    unread_message_count = db.Column(db.Integer, default=0, server_default='0')
+
     def set_password(self, password):
-        """设置密码"""
-        self.password_hash = generate_password_hash(password)
+        """设置密码，哈希在进程池中计算"""
+        self.password_hash = current_app.password_hasher.hash(password)
 
     def check_password(self, password):
-        """校验密码"""
-        return check_password_hash(self.password_hash, password)
+        """校验密码；哈希方法与配置不同时按新方法重新计算，由调用方提交"""
+        hasher = current_app.password_hasher
+        if not hasher.verify(self.id, self.password_hash, password):
+            return False
+        if hasher.needs_rehash(self.password_hash):
+            self.set_password(password)
+            hasher.remember(self.id, self.password_hash, password)
+        return True
 
     def __repr__(self):
         return f'<User {self.username}>'
 
     def avatar(self, size):
         """生成头像链接"""
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
+        digest = email_digest(self.email)
         # 参数d: identicon, monsterid
         return 'https://gravatar.zeruns.tech/avatar/{}?d=identicon&s={}'.format(
             digest, size
         )
 
+    def following_ids(self, users):
+        """users中被A关注的用户id集合，按主键一次查询，用于列表中批量显示关注按钮"""
+        ids = {user.id for user in users if user.id is not None}
+        if not ids:
+            return set()
+        return {id for id, in db.session.query(followers.c.followed_id).filter(
+            followers.c.follower_id == self.id, followers.c.followed_id.in_(ids))}
+
     def is_following(self, user):
-        """A是否关注了B"""
-        return self.followed.filter(followers.c.followed_id == user.id).count() > 0
+        """A是否关注了B；只用于单个用户的页面(user.html、user_popup.html)，列表应对整页调用following_ids"""
+        return user.id in self.following_ids([user])
 
     def follow(self, user):
         """A关注B"""
         if not self.is_following(user):
             self.followed.append(user)
+            self.adjust_counter('followed_count', 1)
+            user.adjust_counter('follower_count', 1)
+            current_app.timeline.follow(db.session, self, user)
+            current_app.suggestions.follow(db.session, self, user)
 
     def unfollow(self, user):
         """A取消关注B"""
         if self.is_following(user):
             self.followed.remove(user)
+            self.adjust_counter('followed_count', -1)
+            user.adjust_counter('follower_count', -1)
+            current_app.timeline.unfollow(db.session, self, user)
+            current_app.suggestions.unfollow(db.session, self, user)
+
+    def follow_many(self, users):
+        """批量关注，一条多行INSERT，返回新关注的用户"""
+        following = self.following_ids(users)
+        new = list({user.id: user for user in users if user.id != self.id and user.id not in following}.values())
+        if new:
+            db.session.execute(followers.insert(), [{'follower_id': self.id, 'followed_id': user.id}
+                                                    for user in new])
+            self._adjust_follow_counts(new, 1)
+            for user in new:
+                current_app.timeline.follow(db.session, self, user)
+                current_app.suggestions.follow(db.session, self, user)
+        return new
+
+    def unfollow_many(self, users):
+        """批量取消关注，一条DELETE，返回取消关注的用户"""
+        following = self.following_ids(users)
+        removed = list({user.id: user for user in users if user.id in following}.values())
+        if removed:
+            for user in removed:
+                current_app.timeline.unfollow(db.session, self, user)
+                current_app.suggestions.unfollow(db.session, self, user)
+            db.session.execute(followers.delete().where(followers.c.follower_id == self.id).where(
+                followers.c.followed_id.in_([user.id for user in removed])))
+            self._adjust_follow_counts(removed, -1)
+        return removed
+
+    def _adjust_follow_counts(self, users, delta):
+        # 被关注者的计数用一条UPDATE修改，再让已加载的对象重新读取
+        self.adjust_counter('followed_count', delta * len(users))
+        User.query.filter(User.id.in_([user.id for user in users])).update(
+            {User.follower_count: User.follower_count + delta}, synchronize_session=False)
+        for user in users:
+            db.session.expire(user, ['follower_count'])
+
+    def who_to_follow(self, count=5):
+        """推荐关注的用户，按共同关注数和活跃度排序"""
+        return current_app.suggestions.for_user(self, count)
+
+    def adjust_counter(self, name, delta):
+        """增减计数列；已持久化的对象在flush时以name = name + delta原子更新"""
+        value = getattr(self, name)
+        if not db.inspect(self).persistent:
+            setattr(self, name, (value or 0) + delta)
+        elif isinstance(value, ClauseElement):
+            setattr(self, name, value + delta)
+        else:
+            setattr(self, name, getattr(User, name) + delta)
+
+    @staticmethod
+    def repair_counters():
+        """按实际数据重新计算所有用户的计数，返回修正的用户数"""
+        counts = {
+            'post_count': db.select(db.func.count(Post.id)).where(
+                Post.user_id == User.id).scalar_subquery(),
+            'follower_count': db.select(db.func.count()).select_from(followers).where(
+                followers.c.followed_id == User.id).scalar_subquery(),
+            'followed_count': db.select(db.func.count()).select_from(followers).where(
+                followers.c.follower_id == User.id).scalar_subquery(),
+            'unread_message_count': db.select(db.func.count(Message.id)).where(
+                Message.recipient_id == User.id,
+                Message.time_stamp > db.func.coalesce(User.last_message_read_time,
+                                                      datetime(1999, 1, 1))).scalar_subquery(),
+        }
+        stale = db.or_(*[db.func.coalesce(getattr(User, name), -1) != count
+                         for name, count in counts.items()])
+        result = db.session.execute(db.update(User).where(stale).values(**counts)
+                                    .execution_options(synchronize_session=False))
+        db.session.commit()
+        return result.rowcount
 
     def get_reset_password_token(self, expires_in=600):
         """生成重置密码所需的令牌"""
@@ -120,6 +277,47 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
             return
         return User.query.get(id)
 
+    def get_export_token(self, filename, expires_in=7 * 24 * 3600):
+        """生成下载导出文件的令牌"""
+        return jwt.encode({'export': self.id, 'filename': filename, 'exp': time() + expires_in},
+                          current_app.config['SECRET_KEY'], algorithm='HS256')
+
+    def verify_export_token(self, token):
+        """令牌有效且属于该用户时返回文件名"""
+        try:
+            payload = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=['HS256'])
+        except jwt.PyJWTError:
+            return
+        if payload.get('export') == self.id:
+            return payload['filename']
+
+    @staticmethod
+    def remove_expired_exports():
+        """删除下载链接已经过期的导出文件(包括中断留下的.part文件)，返回删除的文件数"""
+        folder = current_app.config['EXPORT_FOLDER']
+        if not os.path.isdir(folder):
+            return 0
+        expired = time() - current_app.config['EXPORT_LINK_EXPIRES']
+        removed = 0
+        for entry in os.scandir(folder):
+            if entry.name.startswith('posts-') and entry.stat().st_mtime < expired:
+                os.remove(entry.path)
+                removed += 1
+        return removed
+
+    def export_posts(self, batch_size=1000):
+        """按时间顺序逐条生成导出的post，按(time_stamp, id)分批读取，内存占用与post数量无关
+
+        每批取完才返回，读取期间不占用游标，调用方可以在中途提交事务(例如上报进度)。
+        """
+        query = db.session.query(Post.id, Post.body, Post.time_stamp).filter(Post.user_id == self.id)
+        cursor = ''
+        while cursor is not None:
+            batch = keyset_paginate(query, [Post.time_stamp, Post.id], cursor, batch_size, descending=False)
+            for post in batch.items:
+                yield {'body': post.body, 'time_stamp': post.time_stamp.isoformat() + 'Z'}
+            cursor = batch.next_cursor
+
     def followed_posts(self):
         """查看已关注用户的动态"""
         followed = Post.query.join(followers,
@@ -127,15 +325,38 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         own = Post.query.filter_by(user_id=self.id)
         return followed.union(own).order_by(Post.time_stamp.desc())
 
+    def timeline(self, page, per_page):
+        """从时间线缓存中读取首页动态，返回(posts, has_next)"""
+        return current_app.timeline.page(self, page, per_page)
+
+    def timeline_keyset(self, cursor, per_page):
+        """按游标从时间线缓存中读取首页动态"""
+        return current_app.timeline.keyset(self, cursor, per_page)
+
     def new_messages(self):
-        last_read_time = self.last_message_read_time or datetime(1999, 1, 1)
-        return Message.query.filter_by(recipient=self).filter(
-            Message.time_stamp > last_read_time).count()
+        """未读私信数，读取冗余计数"""
+        if isinstance(self.unread_message_count, ClauseElement):
+            # 还有未flush的原子增量，flush后从数据库读取结果
+            db.session.flush()
+        return self.unread_message_count or 0
+
+    def add_unread_message(self):
+        """收到私信时未读数加一，返回flush后的新未读数"""
+        self.adjust_counter('unread_message_count', 1)
+        return self.new_messages()
+
+    def read_messages(self):
+        """标记私信全部已读"""
+        self.last_message_read_time = datetime.utcnow()
+        self.unread_message_count = 0
+        self.add_notification('unread_message_count', 0)
 
     def add_notification(self, name, data):
         self.notifications.filter_by(name=name).delete()
-        n = Notification(name=name, user=self, payload_json=json.dumps(data))
+        n = Notification(name=name, user=self, payload_json=json.dumps(data), time_stamp=time())
         db.session.add(n)
+        # 提交后推送给订阅了通知流的页面
+        after_commit(db.session, current_app.notifier.publish, self.id, n.to_dict())
         return n
 
     def launch_task(self, name, description, *args, **kwargs):
@@ -147,27 +368,67 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     def get_tasks_in_progress(self):
         return Task.query.filter_by(user=self, complete=False).all()
 
+    def get_tasks_progress(self):
+        """进行中的任务及其进度[(task, progress)]，所有job在一次Redis pipeline中取出
+
+        job已经不存在的任务用一条UPDATE标记为完成，不再返回。
+        """
+        tasks = self.get_tasks_in_progress()
+        if not tasks:
+            return []
+        try:
+            jobs = rq.job.Job.fetch_many([task.id for task in tasks], connection=current_app.redis)
+        except redis.exceptions.RedisError:
+            return [(task, 100) for task in tasks]
+        vanished = [task.id for task, job in zip(tasks, jobs) if job is None]
+        if vanished:
+            Task.query.filter(Task.id.in_(vanished)).update({'complete': True}, synchronize_session=False)
+            db.session.commit()
+        return [(task, job.meta.get('progress', 0)) for task, job in zip(tasks, jobs) if job is not None]
+
     def get_task_in_progress(self, name):
         return Task.query.filter_by(name=name, user=self, complete=False).first()
 
-    def to_dict(self, include_email=False):
+    @staticmethod
+    def link_templates():
+        """to_dict中各链接的模板，每页只需调用一次url_for"""
+        return {name: url_for(endpoint, id=LINK_ID_PLACEHOLDER).replace(str(LINK_ID_PLACEHOLDER), '{}')
+                for name, endpoint in (('self', 'api.get_user'),
+                                       ('followers', 'api.get_followers'),
+                                       ('followed', 'api.get_followed'))}
+
+    @classmethod
+    def to_dict_many(cls, items, include_email=False, viewer=None):
+        """批量序列化，计数来自冗余列，链接模板整页共用，查询数与数量无关
+
+        传入viewer时用一次查询得到viewer是否关注了每个用户。
+        """
+        links = cls.link_templates()
+        following = viewer.following_ids(items) if viewer is not None else None
+        return [item.to_dict(include_email, links, item.id in following if following is not None else None)
+                for item in items]
+
+    def to_dict(self, include_email=False, links=None, is_following=None):
+        links = links or self.link_templates()
         data = {
             'id': self.id,
             'username': self.username,
             'last_seen': self.last_seen.isoformat() + 'Z',
             'about_me': self.about_me,
-            'post_count': self.posts.count(),
-            'follower_count': self.followers.count(),
-            'followed_count': self.followed.count(),
+            'post_count': self.post_count,
+            'follower_count': self.follower_count,
+            'followed_count': self.followed_count,
             '_links': {
-                'self': url_for('api.get_user', id=self.id),
-                'followers': url_for('api.get_followers', id=self.id),
-                'followed': url_for('api.get_followed', id=self.id),
+                'self': links['self'].format(self.id),
+                'followers': links['followers'].format(self.id),
+                'followed': links['followed'].format(self.id),
                 'avatar': self.avatar(128)
             }
         }
         if include_email:
             data['email'] = self.email
+        if is_following is not None:
+            data['is_following'] = is_following
 
         return data
 
@@ -186,62 +447,246 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         self.token = base64.b64encode(os.urandom(24)).decode('utf-8')
         self.token_expiration = now + timedelta(seconds=expires_in)
         db.session.add(self)
+        after_commit(db.session, User.cache_token, self.token, self.id, self.token_expiration)
         return self.token
 
     def revoke_token(self):
         self.token_expiration = datetime.utcnow() - timedelta(seconds=1)
+        if self.token:
+            # 提交前后各删除一次缓存：提交前有请求未命中缓存时会从数据库读到旧的有效期并重新缓存
+            current_app.token_cache.delete(token_digest(self.token))
+            after_commit(db.session, current_app.token_cache.delete, token_digest(self.token))
 
     @staticmethod
-    def check_token(token):
+    def cache_token(token, user_id, expiration):
+        expires_at = (expiration - datetime(1970, 1, 1)).total_seconds()
+        if expires_at > time():
+            current_app.token_cache.set(token_digest(token), [user_id, expires_at],
+                                        ttl=expires_at - time())
+
+    @staticmethod
+    def check_token_id(token):
+        """返回有效令牌对应的用户id，先查缓存，未命中再查数据库"""
+        cached = current_app.token_cache.get(token_digest(token))
+        if cached is not None:
+            user_id, expires_at = cached
+            return user_id if expires_at > time() else None
         user = User.query.filter_by(token=token).first()
         if user is None or user.token_expiration < datetime.utcnow():
             return None
-        return user
-
-
+        User.cache_token(token, user.id, user.token_expiration)
+        return user.id
 
+    @staticmethod
+    def check_token(token):
+        user_id = User.check_token_id(token)
+        return User.query.get(user_id) if user_id is not None else None
 
 
 class SearchableMixin:
     @classmethod
     def search(cls, expression, page, per_page):
         ids, total = query_index(cls.__tablename__, expression, page, per_page)
-        if total == 0:
-            return cls.query.filter_by(id=0), 0
-        # when = []
-        # for i in range(len(ids)):
-        #     when.append((ids[i], i))
-        return cls.query.filter(cls.id.in_(ids)).order_by(cls.id.desc()), total
-        # return cls.query.filter(cls.id.in_(ids)).order_by(db.case(when, value=cls.id)), total
+        if not ids:
+            return cls.query.filter_by(id=0), total
+        # 一次查询取出当前页，按搜索引擎返回的相关度排序
+        when = {id: i for i, id in enumerate(ids)}
+        return cls.query.filter(cls.id.in_(ids)).order_by(db.case(when, value=cls.id)), total
 
     @classmethod
-    def before_commit(cls, session):
-        session._changes = {
-            'add': [obj for obj in session.new if isinstance(obj, cls)],
-            'update': [obj for obj in session.dirty if isinstance(obj, cls)],
-            'delete': [obj for obj in session.deleted if isinstance(obj, cls)]
-        }
+    def after_flush(cls, session, flush_context):
+        """把待索引的变更写入outbox，与业务数据在同一事务中提交"""
+        now = time()
+        rows = [{'index': cls.__tablename__, 'object_id': obj.id, 'operation': operation, 'time_stamp': now}
+                for objs, operation in ((session.new, 'add'), (session.dirty, 'add'),
+                                        (session.deleted, 'delete'))
+                for obj in objs if isinstance(obj, cls)]
+        if rows:
+            session.execute(SearchOutbox.__table__.insert(), rows)
+            session.info['search_outbox'] = True
 
     @classmethod
     def after_commit(cls, session):
-        for obj in session._changes['add']:
-            add_to_index(cls.__tablename__, obj)
-        for obj in session._changes['update']:
-            add_to_index(cls.__tablename__, obj)
-        for obj in session._changes['delete']:
-            remove_from_index(cls.__tablename__, obj)
-        session._changes = None
+        if session.info.pop('search_outbox', False) and not SearchOutbox.schedule():
+            session.info['search_outbox_inline'] = True
+
+    @classmethod
+    def after_transaction_end(cls, session, transaction):
+        # after_commit中不能再执行SQL，等最外层事务结束后再直接处理
+        if transaction.parent is None and session.info.pop('search_outbox_inline', False):
+            SearchOutbox.drain_inline()
+
+    @staticmethod
+    def searchable_models():
+        return {model.__tablename__: model for model in SearchableMixin.__subclasses__()}
 
     @classmethod
-    def reindex(cls):
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
+    def reindex(cls, target=None, after=0, chunk_size=None, workers=4, on_progress=None):
+        """按id顺序流式读取，分块交给线程池批量写入索引，返回写入的文档数
+
+        target为写入的物理索引，默认为当前索引；after为已完成的最大id，用于断点续建。
+        前面的块全部写入后调用on_progress(last_id, done)，last_id可以作为断点保存。
+        读完后会再查一次最大id，重建期间新增的数据也会写入。
+        """
+        backend = current_app.search
+        target = target or cls.__tablename__
+        chunk_size = chunk_size or current_app.config['SEARCH_INDEX_BATCH_SIZE']
+        columns = [getattr(cls, field) for field in cls.__searchable__]
+        pending = deque()
+        done = 0
+
+        def settle(limit):
+            # 按提交顺序确认，保证断点之前的块都已写入；在途的块超过limit时等待最早的一块
+            nonlocal done
+            while pending and (len(pending) > limit or pending[0][0].done()):
+                future, last_id, count = pending.popleft()
+                future.result()
+                done += count
+                if on_progress:
+                    on_progress(last_id, done)
+
+        with ThreadPoolExecutor(workers) as executor:
+            while True:
+                end = db.session.query(db.func.max(cls.id)).scalar() or 0
+                if end <= after:
+                    break
+                rows = db.session.query(cls.id, *columns).filter(cls.id > after, cls.id <= end).order_by(
+                    cls.id).yield_per(chunk_size)
+                chunk = []
+                for row in rows:
+                    chunk.append((row[0], dict(zip(cls.__searchable__, row[1:]))))
+                    if len(chunk) >= chunk_size:
+                        pending.append((executor.submit(backend.add, target, chunk), chunk[-1][0], len(chunk)))
+                        chunk = []
+                        settle(workers * 2)
+                if chunk:
+                    pending.append((executor.submit(backend.add, target, chunk), chunk[-1][0], len(chunk)))
+                after = end
+            settle(0)
+        return done
+
+
+class SearchOutbox(db.Model):
+    """待同步到搜索引擎的变更，由RQ任务app.tasks.index_search_outbox批量消费"""
+    id = db.Column(db.Integer, primary_key=True)
+    index = db.Column(db.String(64))
+    object_id = db.Column(db.Integer)
+    operation = db.Column(db.String(8))  # add 或 delete
+    time_stamp = db.Column(db.Float, default=time)
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt = db.Column(db.Float, index=True, default=0)
+
+    @staticmethod
+    def schedule():
+        """安排一次消费任务，已有任务在排队时不重复安排；Redis不可用时返回False"""
+        try:
+            if current_app.redis.set('search:indexer-scheduled', 1, nx=True, ex=300):
+                current_app.task_queue.enqueue('app.tasks.index_search_outbox')
+        except redis.exceptions.RedisError:
+            return False
+        return True
+
+    @staticmethod
+    def drain_inline(batch_size=None):
+        """无法安排任务时在当前进程中处理一批到期的变更，避免搜索停止更新
+
+        失败时只记录日志，变更按退避留在outbox中，由之后的提交、任务或flask search drain处理。
+        """
+        current_app.logger.warning('Search indexer could not be scheduled, indexing inline')
+        try:
+            SearchOutbox.drain(batch_size or current_app.config['SEARCH_INLINE_BATCH_SIZE'])
+        except Exception:
+            db.session.rollback()
+            current_app.logger.exception('Search indexing failed')
+
+    @staticmethod
+    def schedule_retry():
+        """还有失败后推迟的变更时，安排在最早的重试时间执行一次消费任务
+
+        延迟执行的任务需要worker以rq worker --with-scheduler启动。
+        与schedule()使用不同的标记，等待重试期间新的变更仍会立即安排任务。
+        """
+        next_attempt = db.session.query(db.func.min(SearchOutbox.next_attempt)).scalar()
+        if next_attempt is None:
+            return
+        delay = max(next_attempt - time(), 1)
+        try:
+            if current_app.redis.set('search:indexer-retry', 1, nx=True, ex=int(delay) + 300):
+                current_app.task_queue.enqueue_in(timedelta(seconds=delay), 'app.tasks.index_search_outbox')
+        except redis.exceptions.RedisError:
+            pass
 
+    @staticmethod
+    def drain(batch_size):
+        """批量处理一批到期的变更，返回处理的条数；失败时按指数退避推迟重试"""
+        now = time()
+        rows = SearchOutbox.query.filter(SearchOutbox.next_attempt <= now).order_by(
+            SearchOutbox.id).limit(batch_size).all()
+        if not rows:
+            return 0
+        # 同一对象只执行最后一次操作
+        latest = {(row.index, row.object_id): row.operation for row in rows}
+        changes = {}
+        for (index, object_id), operation in latest.items():
+            changes.setdefault(index, {'add': [], 'delete': []})[operation].append(object_id)
+        models = SearchableMixin.searchable_models()
+        try:
+            for index, ids in changes.items():
+                model = models[index]
+                objs = model.query.filter(model.id.in_(ids['add'])).all() if ids['add'] else []
+                found = {obj.id for obj in objs}
+                add_to_index(index, objs)
+                remove_from_index(index, ids['delete'] + [i for i in ids['add'] if i not in found])
+        except Exception:
+            for row in rows:
+                row.attempts += 1
+                row.next_attempt = now + min(2 ** row.attempts,
+                                             current_app.config['SEARCH_INDEX_MAX_BACKOFF'])
+            db.session.commit()
+            raise
+        SearchOutbox.query.filter(SearchOutbox.id.in_([row.id for row in rows])).delete(
+            synchronize_session=False)
+        db.session.commit()
+        return len(rows)
 
-class Post(SearchableMixin, db.Model):
+    @staticmethod
+    def drain_all(batch_size):
+        """处理所有到期的变更，返回成功处理的条数
+
+        某一批失败时记录日志，这批推迟重试后继续处理后面的批次。
+        失败后到期的变更没有减少(例如数据库本身出错)时不再继续，抛出异常。
+        """
+        total = 0
+        due = None
+        while True:
+            try:
+                done = SearchOutbox.drain(batch_size)
+            except Exception:
+                db.session.rollback()
+                current_app.logger.exception('Search indexing failed')
+                remaining = SearchOutbox.query.filter(SearchOutbox.next_attempt <= time()).count()
+                if due is not None and remaining >= due:
+                    raise
+                due = remaining
+                continue
+            if not done:
+                return total
+            total += done
+
+    @staticmethod
+    def backlog():
+        """积压的变更数和最早一条的延迟(秒)"""
+        pending, oldest = db.session.query(db.func.count(SearchOutbox.id),
+                                           db.func.min(SearchOutbox.time_stamp)).one()
+        return {'pending': pending, 'lag': time() - oldest if oldest else 0}
+
+
+class Post(PaginatedAPIMixin, SearchableMixin, db.Model):
     """用户动态表"""
 
     __searchable__ = ['body']
+    __keyset__ = ('time_stamp', 'id')
+    __keyset_descending__ = True
 
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(140))
@@ -252,9 +697,103 @@ class Post(SearchableMixin, db.Model):
     def __repr__(self):
         return f'<Post {self.body}>'
 
+    @staticmethod
+    def api_query():
+        """API只查询序列化需要的列，不加载Post对象"""
+        return db.session.query(Post.id, Post.body, Post.time_stamp, Post.language, Post.user_id)
+
+    @staticmethod
+    def link_templates():
+        return {name: url_for(endpoint, id=LINK_ID_PLACEHOLDER).replace(str(LINK_ID_PLACEHOLDER), '{}')
+                for name, endpoint in (('self', 'api.get_post'), ('author', 'api.get_user'))}
+
+    @classmethod
+    def to_dict_many(cls, items):
+        """批量序列化，items可以是Post对象或api_query()的行，作者名用一次查询取出"""
+        links = cls.link_templates()
+        user_ids = {item.user_id for item in items}
+        usernames = dict(db.session.query(User.id, User.username).filter(
+            User.id.in_(user_ids))) if user_ids else {}
+        return [{
+            'id': item.id,
+            'body': item.body,
+            'time_stamp': item.time_stamp.isoformat() + 'Z',
+            'language': item.language,
+            'author': {
+                'id': item.user_id,
+                'username': usernames.get(item.user_id),
+                '_links': {'self': links['author'].format(item.user_id)}
+            },
+            '_links': {'self': links['self'].format(item.id)}
+        } for item in items]
+
+    def to_dict(self):
+        return self.to_dict_many([self])[0]
 
-db.event.listen(db.session, 'before_commit', Post.before_commit)
+    @classmethod
+    def before_flush(cls, session, flush_context, instances):
+        """维护作者的post_count"""
+        for objs, delta in ((session.new, 1), (session.deleted, -1)):
+            for obj in objs:
+                if isinstance(obj, cls):
+                    author = obj.author or session.get(User, obj.user_id)
+                    if author is not None:
+                        author.adjust_counter('post_count', delta)
+
+    @classmethod
+    def push_to_timelines(cls, session, flush_context):
+        """新post写入后，推送到作者和粉丝的时间线(提交后生效)"""
+        for obj in session.new:
+            if isinstance(obj, cls):
+                follower_ids = [follower_id for follower_id, in session.execute(
+                    db.select(followers.c.follower_id).where(followers.c.followed_id == obj.user_id))]
+                current_app.timeline.push(session, obj, [obj.user_id] + follower_ids)
+
+    @classmethod
+    def pull_from_timelines(cls, session, flush_context):
+        """post删除后，从作者和粉丝的时间线中移除(提交后生效)"""
+        deleted = {}
+        for obj in session.deleted:
+            if isinstance(obj, cls):
+                deleted.setdefault(obj.user_id, []).append(obj.id)
+        for user_id, post_ids in deleted.items():
+            follower_ids = [follower_id for follower_id, in session.execute(
+                db.select(followers.c.follower_id).where(followers.c.followed_id == user_id))]
+            current_app.timeline.pull(session, post_ids, [user_id] + follower_ids)
+
+    @staticmethod
+    def schedule_language_detection(ids):
+        """提交后在RQ任务中识别语言，Redis不可用时直接识别"""
+        try:
+            current_app.task_queue.enqueue('app.tasks.detect_post_languages', ids)
+        except redis.exceptions.RedisError:
+            Post.detect_languages(ids)
+
+    @staticmethod
+    def detect_languages(ids):
+        """识别language为空的post的语言并批量写入，返回更新的条数
+
+        直接UPDATE而不经过ORM，语言不参与搜索，不需要重新索引。
+        """
+        detector = current_app.language_detector
+        rows = [{'post_id': id, 'lang': detector.detect(body)} for id, body in db.session.query(
+            Post.id, Post.body).filter(Post.id.in_(ids), Post.language.is_(None))]
+        if rows:
+            post = Post.__table__
+            db.session.execute(post.update().where(post.c.id == db.bindparam('post_id'))
+                               .values(language=db.bindparam('lang')), rows)
+            db.session.commit()
+        return len(rows)
+
+
+db.event.listen(db.session, 'after_flush', Post.after_flush)
 db.event.listen(db.session, 'after_commit', Post.after_commit)
+db.event.listen(db.session, 'after_transaction_end', Post.after_transaction_end)
+db.event.listen(db.session, 'before_flush', Post.before_flush)
+db.event.listen(db.session, 'after_flush', Post.push_to_timelines)
+db.event.listen(db.session, 'after_flush', Post.pull_from_timelines)
+db.event.listen(db.session, 'after_commit', run_after_commit)
+db.event.listen(db.session, 'after_soft_rollback', discard_after_commit)
 
 
 class Message(db.Model):
@@ -278,6 +817,13 @@ class Notification(db.Model):
     def get_data(self):
         return json.loads(str(self.payload_json)) #这里为什么还需要用str？
 
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'data': self.get_data(),
+            'time_stamp': int(self.time_stamp)
+        }
+
 
 class Task(db.Model):
     id = db.Column(db.String(36), primary_key=True)
@@ -0,0 +1,86 @@
+import base64
+import json
+from datetime import datetime
+from flask import current_app, request
+from sqlalchemy import DateTime, Integer, String, and_, or_
+
+
+def encode_cursor(direction, values):
+    """把翻页方向和边界行的排序键编码成不透明的游标字符串"""
+    values = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    return base64.urlsafe_b64encode(json.dumps([direction] + values).encode('utf-8')).decode('utf-8')
+
+
+def _cursor_value(column, value):
+    """按列类型检查游标中的值，类型不符时抛出ValueError，避免把任意JSON值带进SQL"""
+    if isinstance(column.type, DateTime):
+        if not isinstance(value, str):
+            raise ValueError
+        return datetime.fromisoformat(value)
+    if isinstance(column.type, Integer):
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise ValueError
+        return value
+    if isinstance(column.type, String):
+        if not isinstance(value, str):
+            raise ValueError
+        return value
+    raise ValueError
+
+
+def decode_cursor(cursor, columns):
+    """解析游标，返回(direction, values)；游标无效时抛出ValueError"""
+    try:
+        direction, *values = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')))
+        if direction not in ('next', 'prev') or len(values) != len(columns):
+            raise ValueError
+        return direction, [_cursor_value(c, v) for c, v in zip(columns, values)]
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError('invalid cursor')
+
+
+def cursor_arg():
+    """游标分页模式下返回请求的游标(第一页为'')，页码模式返回None"""
+    if 'cursor' in request.args:
+        return request.args['cursor']
+    if current_app.config['CURSOR_PAGINATION'] and 'page' not in request.args:
+        return ''
+    return None
+
+
+def _after(columns, values, descending):
+    """(c1, c2, ...)在排序方向上位于values之后的条件"""
+    column, value = columns[0], values[0]
+    beyond = column < value if descending else column > value
+    if len(columns) == 1:
+        return beyond
+    return or_(beyond, and_(column == value, _after(columns[1:], values[1:], descending)))
+
+
+class KeysetPagination:
+    """游标分页的结果，不做COUNT"""
+
+    def __init__(self, items, columns, direction, has_more, has_cursor):
+        self.items = items
+        if direction == 'prev':
+            self.has_prev, self.has_next = has_more, True
+        else:
+            self.has_prev, self.has_next = has_cursor, has_more
+        keys = [[getattr(item, c.key) for c in columns] for item in items]
+        self.next_cursor = encode_cursor('next', keys[-1]) if self.has_next and keys else None
+        self.prev_cursor = encode_cursor('prev', keys[0]) if self.has_prev and keys else None
+
+
+def keyset_paginate(query, columns, cursor, per_page, descending=True):
+    """按columns做keyset分页，columns需唯一确定一行，例如(Post.time_stamp, Post.id)"""
+    direction, values = decode_cursor(cursor, columns) if cursor else ('next', None)
+    forward = descending if direction == 'next' else not descending
+    if values is not None:
+        query = query.filter(_after(columns, values, forward))
+    query = query.order_by(None).order_by(*[c.desc() if forward else c.asc() for c in columns])
+    items = query.limit(per_page + 1).all()
+    has_more = len(items) > per_page
+    items = items[:per_page]
+    if direction == 'prev':
+        items.reverse()
+    return KeysetPagination(items, columns, direction, has_more, values is not None)
@@ -0,0 +1,78 @@
+import hmac
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class PasswordHasherBusy(ServiceUnavailable):
+    description = 'Too many password checks in progress, please try again later.'
+
+
+class PasswordHasher:
+    """在进程池中计算和校验密码哈希，不占用web线程的CPU时间
+
+    排队和执行中的任务数超过PASSWORD_HASH_QUEUE_SIZE时直接抛出PasswordHasherBusy(503)，
+    不再继续排队。PASSWORD_HASH_WORKERS为0时在当前线程中计算。
+    校验成功的(用户, 哈希, 密码)以带SECRET_KEY的HMAC摘要为键短时间缓存，不保存密码本身；
+    修改密码后哈希变了，旧的缓存自然失效。
+    """
+
+    def __init__(self, app=None):
+        self.executor = None
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.method = app.config['PASSWORD_HASH_METHOD']
+        self.workers = app.config['PASSWORD_HASH_WORKERS']
+        self.slots = threading.BoundedSemaphore(app.config['PASSWORD_HASH_QUEUE_SIZE'])
+        self.secret = app.config['SECRET_KEY'].encode('utf-8')
+        self.cache = app.credential_cache
+
+    def _executor(self):
+        with self.lock:
+            if self.executor is None:
+                # web进程是多线程的，用spawn启动子进程而不是fork
+                self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self.executor
+
+    def _run(self, func, *args):
+        if not self.slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+        try:
+            if not self.workers:
+                return func(*args)
+            return self._executor().submit(func, *args).result()
+        finally:
+            self.slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def needs_rehash(self, password_hash):
+        """哈希不是用当前配置的方法(含迭代次数)计算的"""
+        return password_hash.split('$', 1)[0] != self.method
+
+    def _digest(self, user_id, password_hash, password):
+        message = f'{user_id}\0{password_hash}\0{password}'.encode('utf-8')
+        return hmac.new(self.secret, message, sha256).hexdigest()
+
+    def verify(self, user_id, password_hash, password):
+        """校验密码，成功的校验会被缓存"""
+        if not password_hash:
+            return False
+        key = self._digest(user_id, password_hash, password)
+        if self.cache.get(key):
+            return True
+        if not self._run(check_password_hash, password_hash, password):
+            return False
+        self.remember(user_id, password_hash, password)
+        return True
+
+    def remember(self, user_id, password_hash, password):
+        """缓存一次已知成功的校验，例如重新计算哈希之后"""
+        self.cache.set(self._digest(user_id, password_hash, password), 1)
@@ -0,0 +1,64 @@
+from time import time
+import json
+import redis
+from flask import current_app
+from app import db
+from app.models import Task, Notification
+
+
+class TaskProgress:
+    """RQ任务的进度上报
+
+    进度变化不到TASK_PROGRESS_STEP且距上次上报不到TASK_PROGRESS_INTERVAL秒时跳过，
+    100%和失败总是上报。每次上报只写一次job meta，通知和任务状态用几条SQL在一次提交中写入，
+    不再逐次加载Task和User对象。
+    """
+
+    def __init__(self, job):
+        self.job = job
+        self.step = current_app.config['TASK_PROGRESS_STEP']
+        self.interval = current_app.config['TASK_PROGRESS_INTERVAL']
+        self.reported = None
+        self.reported_at = 0
+        self.user_id = None
+        if job is not None:
+            self.user_id = db.session.query(Task.user_id).filter_by(id=job.get_id()).scalar()
+
+    def update(self, progress):
+        """记录进度，需要上报时上报，返回是否上报"""
+        if self.reported is not None and progress < 100 and progress - self.reported < self.step \
+                and time() - self.reported_at < self.interval:
+            return False
+        self.report(progress)
+        return True
+
+    def fail(self):
+        self.report(100, failed=True)
+
+    def report(self, progress, failed=False):
+        self.reported, self.reported_at = progress, time()
+        if self.job is None:
+            return
+        self.job.meta['progress'] = progress
+        if failed:
+            self.job.meta['failed'] = True
+        try:
+            self.job.save_meta()
+        except redis.exceptions.RedisError:
+            pass
+        if self.user_id is None:
+            return
+        data = {'task_id': self.job.get_id(), 'progress': progress}
+        if failed:
+            data['failed'] = True
+        notification = Notification.__table__
+        now = time()
+        db.session.execute(notification.delete().where(
+            notification.c.user_id == self.user_id).where(notification.c.name == 'task_progress'))
+        db.session.execute(notification.insert().values(
+            user_id=self.user_id, name='task_progress', payload_json=json.dumps(data), time_stamp=now))
+        if progress >= 100:
+            db.session.execute(Task.__table__.update().where(Task.id == self.job.get_id()).values(complete=True))
+        db.session.commit()
+        current_app.notifier.publish(self.user_id, {'name': 'task_progress', 'data': data,
+                                                    'time_stamp': int(now)})
@@ -0,0 +1,71 @@
+import json
+import queue
+import threading
+import redis
+
+
+class RedisSubscription:
+    def __init__(self, connection, channel):
+        self.pubsub = connection.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(channel)
+
+    def get(self, timeout):
+        message = self.pubsub.get_message(timeout=timeout)
+        if message is None or message['type'] != 'message':
+            return None
+        return json.loads(message['data'])
+
+    def close(self):
+        self.pubsub.close()
+
+
+class LocalSubscription:
+    def __init__(self, broker, channel):
+        self.broker = broker
+        self.channel = channel
+        self.queue = queue.Queue()
+        with broker.lock:
+            broker.subscribers.setdefault(channel, set()).add(self.queue)
+
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        with self.broker.lock:
+            self.broker.subscribers.get(self.channel, set()).discard(self.queue)
+
+
+class NotificationBroker:
+    """按用户推送通知，使用Redis发布订阅，Redis不可用时只在本进程内推送"""
+
+    def __init__(self, app=None):
+        self.subscribers = {}
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.redis = app.redis
+
+    @staticmethod
+    def channel(user_id):
+        return f'notifications:{user_id}'
+
+    def publish(self, user_id, event):
+        try:
+            self.redis.publish(self.channel(user_id), json.dumps(event))
+        except redis.exceptions.RedisError:
+            with self.lock:
+                subscribers = list(self.subscribers.get(self.channel(user_id), ()))
+            for subscriber in subscribers:
+                subscriber.put(event)
+
+    def subscribe(self, user_id):
+        """订阅用户的通知，返回的对象通过get(timeout)取下一条，用完后close()"""
+        try:
+            return RedisSubscription(self.redis, self.channel(user_id))
+        except redis.exceptions.RedisError:
+            return LocalSubscription(self, self.channel(user_id))
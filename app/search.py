@@ -1,27 +1,297 @@
+import re
+import sqlite3
+import threading
+from datetime import datetime
+from hashlib import md5
+from time import time
 from flask import current_app
+from elasticsearch import helpers, NotFoundError
 
 
-def add_to_index(index, model):
-    if not current_app.elasticsearch:
-        return
-    payload = {}
-    for field in model.__searchable__:
-        payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, id=model.id, body=payload)
+def to_document(model):
+    """(id, 字段)形式的文档，交给后端时不再访问ORM对象"""
+    return model.id, {field: getattr(model, field) for field in model.__searchable__}
 
 
-def remove_from_index(index, model):
-    if not current_app.elasticsearch:
-        return
-    current_app.elasticsearch.delete(index=index, id=model.id)
+def write_targets(index):
+    """变更要写入的索引：别名index，正在重建时还有重建中的新索引，切换后新索引不会缺少重建期间的变更"""
+    target = current_app.search.rebuild_target(index)
+    return [index] if target is None else [index, target]
+
+
+def add_to_index(index, models):
+    """批量写入或更新索引"""
+    if models:
+        documents = [to_document(model) for model in models]
+        for name in write_targets(index):
+            current_app.search.add(name, documents)
+        invalidate_cache(index)
+
+
+def remove_from_index(index, ids):
+    """批量从索引中删除，文档不存在时忽略"""
+    if ids:
+        for name in write_targets(index):
+            current_app.search.remove(name, ids)
+        invalidate_cache(index)
+
+
+def switch_index(index, target):
+    """重建完成后把别名index切换到新索引target"""
+    current_app.search.switch_alias(index, target)
+    invalidate_cache(index)
+
+
+def cache_version(index):
+    """索引的缓存版本号，缓存键中带上版本号，换版本即让该索引的缓存整体失效"""
+    version = current_app.search_cache.get(f'version:{index}')
+    if version is None:
+        version = invalidate_cache(index)
+    return version
+
+
+def invalidate_cache(index):
+    version = time()
+    current_app.search_cache.set(f'version:{index}', version)
+    return version
 
 
 def query_index(index, query, page, per_page):
-    if not current_app.elasticsearch:
-        return [], 0
-    search = current_app.elasticsearch.search(
-        index=index,
-        body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
-              'from': (page - 1) * per_page, 'size': per_page})
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']['value']
\ No newline at end of file
+    """返回(当前页的id列表, 命中总数)，id按相关度排序
+
+    前SEARCH_CACHE_WINDOW个结果的id按(索引, 规范化后的查询)缓存，翻页时直接从中切片。
+    """
+    query = ' '.join(query.lower().split())
+    window = current_app.config['SEARCH_CACHE_WINDOW']
+    if page * per_page > window:
+        return current_app.search.query(index, query, page, per_page)
+    key = f'{index}:{cache_version(index)}:{md5(query.encode("utf-8")).hexdigest()}'
+    result = current_app.search_cache.get(key)
+    if result is None:
+        ids, total = current_app.search.query(index, query, 1, window)
+        result = {'ids': ids, 'total': total}
+        current_app.search_cache.set(key, result)
+    start = (page - 1) * per_page
+    return result['ids'][start:start + per_page], result['total']
+
+
+class SearchBackend:
+    """搜索后端接口，index可以是别名；documents为[(id, {字段: 值})]"""
+
+    def add(self, index, documents):
+        raise NotImplementedError
+
+    def remove(self, index, ids):
+        raise NotImplementedError
+
+    def query(self, index, query, page, per_page):
+        raise NotImplementedError
+
+    def create_index(self, index, fields):
+        """新建一个物理索引用于重建并登记为index正在重建的索引，返回它的名字"""
+        raise NotImplementedError
+
+    def rebuild_target(self, index):
+        """index正在重建的新索引，没有在重建时返回None"""
+        raise NotImplementedError
+
+    def switch_alias(self, index, target):
+        """把别名index指向target，删除原来的索引并结束重建"""
+        raise NotImplementedError
+
+
+class ElasticsearchBackend(SearchBackend):
+    def __init__(self, client):
+        self.client = client
+
+    def add(self, index, documents):
+        helpers.bulk(self.client, [{'_op_type': 'index', '_index': index, '_id': id, '_source': source}
+                                   for id, source in documents])
+
+    def remove(self, index, ids):
+        helpers.bulk(self.client, [{'_op_type': 'delete', '_index': index, '_id': id} for id in ids],
+                     ignore_status=(404,))
+
+    def query(self, index, query, page, per_page):
+        search = self.client.search(
+            index=index,
+            body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
+                  'from': (page - 1) * per_page, 'size': per_page})
+        ids = [int(hit['_id']) for hit in search['hits']['hits']]
+        return ids, search['hits']['total']['value']
+
+    def create_index(self, index, fields):
+        name = f'{index}-{datetime.utcnow():%Y%m%d%H%M%S}'
+        self.client.indices.create(index=name)
+        # 以别名<index>-rebuild登记，上一次中断的重建登记的别名一并移除
+        actions = [{'add': {'index': name, 'alias': f'{index}-rebuild'}}]
+        previous = self.rebuild_target(index)
+        if previous is not None:
+            actions.append({'remove': {'index': previous, 'alias': f'{index}-rebuild'}})
+        self.client.indices.update_aliases(body={'actions': actions})
+        return name
+
+    def rebuild_target(self, index):
+        try:
+            return next(iter(self.client.indices.get_alias(name=f'{index}-rebuild')), None)
+        except NotFoundError:
+            return None
+
+    def switch_alias(self, index, target):
+        actions = [{'add': {'index': target, 'alias': index}},
+                   {'remove': {'index': target, 'alias': f'{index}-rebuild'}}]
+        old = []
+        if self.client.indices.exists_alias(name=index):
+            old = [name for name in self.client.indices.get_alias(name=index) if name != target]
+            actions += [{'remove': {'index': name, 'alias': index}} for name in old]
+        elif self.client.indices.exists(index=index):
+            # 原来直接以index为名的索引，在切换别名的同一操作中删除
+            actions.append({'remove_index': {'index': index}})
+        self.client.indices.update_aliases(body={'actions': actions})
+        for name in old:
+            self.client.indices.delete(index=name)
+
+
+# 中日韩文字没有空格分词，按单字和相邻两字切分
+CJK = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff'
+TOKEN_RE = re.compile(f'[{CJK}]+|[^\\W_{CJK}]+')
+CJK_RE = re.compile(f'[{CJK}]')
+
+
+def tokenize(text, for_query=False):
+    """把文本切分成词：英文等按单词小写，中日韩文字建索引时取单字和双字，查询时取双字(仅一个字时取单字)"""
+    tokens = []
+    for word in TOKEN_RE.findall(text.lower()):
+        if not CJK_RE.match(word):
+            tokens.append(word)
+            continue
+        bigrams = [word[i:i + 2] for i in range(len(word) - 1)]
+        if for_query:
+            tokens.extend(bigrams or [word])
+        else:
+            tokens.extend(list(word) + bigrams)
+    return tokens
+
+
+class LocalSearchBackend(SearchBackend):
+    """基于SQLite FTS5的内置搜索引擎，按BM25排序，不依赖外部服务
+
+    文本先在Python中切分成词再以空格连接写入，FTS5只按空格切分，所以中英文混排也能检索。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        return self.connection
+
+    @staticmethod
+    def _check_name(name):
+        if not re.fullmatch(r'\w+', name):
+            raise ValueError(f'invalid index name: {name}')
+        return name
+
+    def table(self, connection, index):
+        """索引对应的表fts_<index>，index是别名时先按search_alias表解析"""
+        try:
+            row = connection.execute('SELECT target FROM search_alias WHERE alias = ?', (index,)).fetchone()
+        except sqlite3.OperationalError:
+            row = None
+        return f'fts_{self._check_name(row[0] if row else index)}'
+
+    @staticmethod
+    def _ensure_table(connection, table, fields):
+        connection.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {table} "
+                           f"USING fts5({', '.join(fields)}, tokenize='unicode61')")
+
+    def add(self, index, documents):
+        fields = list(documents[0][1])
+        rows = [[id] + [' '.join(tokenize(source[field] or '')) for field in fields]
+                for id, source in documents]
+        with self.lock:
+            connection = self._connect()
+            with connection:
+                table = self.table(connection, index)
+                self._ensure_table(connection, table, fields)
+                connection.executemany(f'DELETE FROM {table} WHERE rowid = ?', [(row[0],) for row in rows])
+                connection.executemany(
+                    f'INSERT INTO {table} (rowid, {", ".join(fields)}) '
+                    f'VALUES ({", ".join("?" * (len(fields) + 1))})', rows)
+
+    @staticmethod
+    def _ensure_alias_table(connection):
+        connection.execute('CREATE TABLE IF NOT EXISTS search_alias (alias TEXT PRIMARY KEY, target TEXT)')
+
+    def create_index(self, index, fields):
+        name = f'{self._check_name(index)}_{datetime.utcnow():%Y%m%d%H%M%S}'
+        with self.lock:
+            connection = self._connect()
+            with connection:
+                self._ensure_table(connection, f'fts_{name}', fields)
+                # 以别名<index>:rebuild登记正在重建的索引
+                self._ensure_alias_table(connection)
+                connection.execute('INSERT OR REPLACE INTO search_alias (alias, target) VALUES (?, ?)',
+                                   (f'{index}:rebuild', name))
+        return name
+
+    def rebuild_target(self, index):
+        with self.lock:
+            connection = self._connect()
+            try:
+                row = connection.execute('SELECT target FROM search_alias WHERE alias = ?',
+                                         (f'{index}:rebuild',)).fetchone()
+            except sqlite3.OperationalError:
+                row = None
+        return row[0] if row else None
+
+    def switch_alias(self, index, target):
+        with self.lock:
+            connection = self._connect()
+            with connection:
+                old = self.table(connection, index)
+                self._ensure_alias_table(connection)
+                connection.execute('INSERT OR REPLACE INTO search_alias (alias, target) VALUES (?, ?)',
+                                   (index, self._check_name(target)))
+                connection.execute('DELETE FROM search_alias WHERE alias = ?', (f'{index}:rebuild',))
+                if old != f'fts_{target}':
+                    connection.execute(f'DROP TABLE IF EXISTS {old}')
+
+    def remove(self, index, ids):
+        with self.lock:
+            connection = self._connect()
+            with connection:
+                try:
+                    connection.executemany(f'DELETE FROM {self.table(connection, index)} WHERE rowid = ?',
+                                           [(id,) for id in ids])
+                except sqlite3.OperationalError:
+                    # 索引还未建立
+                    pass
+
+    def query(self, index, query, page, per_page):
+        tokens = tokenize(query, for_query=True)
+        if not tokens:
+            return [], 0
+        expression = ' OR '.join('"{}"'.format(token.replace('"', '""')) for token in tokens)
+        with self.lock:
+            connection = self._connect()
+            table = self.table(connection, index)
+            try:
+                total = connection.execute(f'SELECT count(*) FROM {table} WHERE {table} MATCH ?',
+                                           (expression,)).fetchone()[0]
+                ids = [row[0] for row in connection.execute(
+                    f'SELECT rowid FROM {table} WHERE {table} MATCH ? ORDER BY bm25({table}) '
+                    f'LIMIT ? OFFSET ?', (expression, per_page, (page - 1) * per_page))]
+            except sqlite3.OperationalError:
+                return [], 0
+        return ids, total
+
+
+def create_backend(app):
+    """配置了Elasticsearch时使用它，否则使用内置搜索引擎"""
+    if app.elasticsearch:
+        return ElasticsearchBackend(app.elasticsearch)
+    return LocalSearchBackend(app.config['SEARCH_DATABASE'])
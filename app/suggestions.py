@@ -0,0 +1,241 @@
+import heapq
+import threading
+from array import array
+from collections import Counter, OrderedDict, defaultdict
+from datetime import datetime
+import redis
+from app.cache import after_commit
+
+
+class RedisSuggestionBackend:
+    """每个用户一个有序集合，member为推荐的用户id，score为得分
+
+    Redis不保存空的有序集合，没有候选的用户另存一个有过期时间的标记，表示已经计算过。
+    """
+
+    def __init__(self, connection, size, empty_ttl):
+        self.redis = connection
+        self.size = size
+        self.empty_ttl = empty_ttl
+
+    @staticmethod
+    def key(user_id):
+        return f'suggestions:{user_id}'
+
+    @staticmethod
+    def empty_key(user_id):
+        return f'suggestions:{user_id}:empty'
+
+    def exists(self, user_id):
+        return self.redis.exists(self.key(user_id), self.empty_key(user_id)) > 0
+
+    def replace_many(self, suggestions):
+        pipe = self.redis.pipeline(transaction=False)
+        for user_id, scores in suggestions.items():
+            pipe.delete(self.key(user_id))
+            if scores:
+                pipe.delete(self.empty_key(user_id))
+                pipe.zadd(self.key(user_id), scores)
+            else:
+                pipe.set(self.empty_key(user_id), 1, ex=self.empty_ttl)
+        pipe.execute()
+
+    def adjust(self, changes, delta):
+        # 只调整已建立的推荐列表，未建立的在读取时重新计算；原来为空的标记删除，读取时重新计算
+        user_ids = list({user_id for user_id, _ in changes})
+        pipe = self.redis.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.delete(self.empty_key(user_id))
+            pipe.exists(self.key(user_id))
+        user_ids = {user_id for user_id, found in zip(user_ids, pipe.execute()[1::2]) if found}
+        pipe = self.redis.pipeline(transaction=False)
+        for user_id, candidate_id in changes:
+            if user_id in user_ids:
+                pipe.zincrby(self.key(user_id), delta, candidate_id)
+        for user_id in user_ids:
+            # 去掉不再有共同关注的候选(得分只剩活跃度加分，小于1)，只保留前size个
+            pipe.zremrangebyscore(self.key(user_id), '-inf', '(1')
+            pipe.zremrangebyrank(self.key(user_id), 0, -self.size - 1)
+        pipe.execute()
+
+    def remove(self, user_id, candidate_id):
+        self.redis.zrem(self.key(user_id), candidate_id)
+
+    def top(self, user_id, count):
+        return [int(candidate_id) for candidate_id in self.redis.zrevrange(self.key(user_id), 0, count - 1)]
+
+
+class MemorySuggestionBackend:
+    """Redis不可用时的进程内实现，最多保存max_users个最近使用的用户"""
+
+    def __init__(self, size, max_users):
+        self.size = size
+        self.max_users = max_users
+        self.suggestions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def exists(self, user_id):
+        return user_id in self.suggestions
+
+    def _store(self, user_id, scores):
+        with self.lock:
+            self.suggestions[user_id] = scores
+            self.suggestions.move_to_end(user_id)
+            while len(self.suggestions) > self.max_users:
+                self.suggestions.popitem(last=False)
+
+    def replace_many(self, suggestions):
+        for user_id, scores in suggestions.items():
+            self._store(user_id, dict(scores))
+
+    def adjust(self, changes, delta):
+        # 只调整已建立的推荐列表，在副本上计算，期间被淘汰的用户不会以空列表重新写入
+        updated = {}
+        for user_id, candidate_id in changes:
+            if user_id not in updated:
+                current = self.suggestions.get(user_id)
+                if current is None:
+                    continue
+                updated[user_id] = dict(current)
+            scores = updated[user_id]
+            scores[candidate_id] = scores.get(candidate_id, 0) + delta
+        for user_id, scores in updated.items():
+            scores = {c: s for c, s in scores.items() if s >= 1}
+            self._store(user_id, dict(heapq.nlargest(self.size, scores.items(), key=lambda item: item[1])))
+
+    def remove(self, user_id, candidate_id):
+        self.suggestions.get(user_id, {}).pop(candidate_id, None)
+
+    def top(self, user_id, count):
+        with self.lock:
+            if user_id in self.suggestions:
+                self.suggestions.move_to_end(user_id)
+        scores = self.suggestions.get(user_id, {})
+        return [c for c, s in heapq.nlargest(count, scores.items(), key=lambda item: item[1])]
+
+
+class Suggestions:
+    """"你可能想关注"的推荐
+
+    候选为关注的人所关注的人，得分为共同关注数加上按最近发表时间衰减的活跃度加分(0到1之间)。
+    关注和取消关注时增量调整共同关注数，活跃度在批量刷新(RQ任务或flask suggestions refresh)时更新。
+    每个用户只保存得分最高的SUGGESTIONS_SIZE个候选，读取时再去掉已经关注的人。
+    """
+
+    def __init__(self, app=None):
+        self.redis_backend = None
+        self.memory_backend = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.size = app.config['SUGGESTIONS_SIZE']
+        self.half_life = app.config['SUGGESTIONS_ACTIVITY_HALF_LIFE']
+        self.redis_backend = RedisSuggestionBackend(app.redis, self.size, app.config['SUGGESTIONS_EMPTY_TTL'])
+        self.memory_backend = MemorySuggestionBackend(self.size, app.config['SUGGESTIONS_MEMORY_USERS'])
+
+    def _call(self, method, *args, **kwargs):
+        try:
+            return getattr(self.redis_backend, method)(*args, **kwargs)
+        except redis.exceptions.RedisError:
+            return getattr(self.memory_backend, method)(*args, **kwargs)
+
+    @staticmethod
+    def _neighbours(user, followed):
+        """followed关注的人，以及关注了user的人"""
+        from app import db
+        from app.models import followers
+        followed_ids = [id for id, in db.session.query(followers.c.followed_id).filter(
+            followers.c.follower_id == followed.id, followers.c.followed_id != user.id)]
+        follower_ids = [id for id, in db.session.query(followers.c.follower_id).filter(
+            followers.c.followed_id == user.id, followers.c.follower_id != followed.id)]
+        return followed_ids, follower_ids
+
+    def _changes(self, user, followed):
+        followed_ids, follower_ids = self._neighbours(user, followed)
+        return [(user.id, candidate_id) for candidate_id in followed_ids] + \
+            [(follower_id, followed.id) for follower_id in follower_ids]
+
+    def follow(self, session, user, followed):
+        """user关注followed后：followed关注的人成为user的候选，followed成为user的粉丝的候选"""
+        changes = self._changes(user, followed)
+        after_commit(session, self._call, 'remove', user.id, followed.id)
+        if changes:
+            after_commit(session, self._call, 'adjust', changes, 1)
+
+    def unfollow(self, session, user, followed):
+        changes = self._changes(user, followed)
+        if changes:
+            after_commit(session, self._call, 'adjust', changes, -1)
+
+    def activity(self, last_post):
+        """按最近一次发表距今的天数衰减的活跃度加分"""
+        if last_post is None:
+            return 0
+        days = (datetime.utcnow() - last_post).total_seconds() / 86400
+        return 0.999 * 0.5 ** (max(days, 0) / self.half_life)
+
+    def compute(self, follows, activity, user_ids=None):
+        """根据邻接表follows{用户id: 关注的id数组}计算推荐，返回{用户id: {候选id: 得分}}"""
+        result = {}
+        for user_id in follows if user_ids is None else user_ids:
+            followed = follows.get(user_id, ())
+            shared = Counter()
+            for followed_id in followed:
+                shared.update(follows.get(followed_id, ()))
+            excluded = set(followed)
+            excluded.add(user_id)
+            scores = ((candidate_id, count + activity.get(candidate_id, 0))
+                      for candidate_id, count in shared.items() if candidate_id not in excluded)
+            result[user_id] = dict(heapq.nlargest(self.size, scores, key=lambda item: item[1]))
+        return result
+
+    def load_graph(self):
+        """把关注关系读成按用户id分组的整数数组，以及每个用户的活跃度"""
+        from app import db
+        from app.models import followers, Post
+        follows = defaultdict(lambda: array('l'))
+        for follower_id, followed_id in db.session.execute(
+                db.select(followers.c.follower_id, followers.c.followed_id)).yield_per(10000):
+            follows[follower_id].append(followed_id)
+        activity = {user_id: self.activity(last_post) for user_id, last_post in db.session.query(
+            Post.user_id, db.func.max(Post.time_stamp)).group_by(Post.user_id)}
+        return dict(follows), activity
+
+    def refresh(self, batch_size=1000):
+        """批量重新计算所有用户的推荐，返回计算的用户数"""
+        from app import db
+        from app.models import User
+        follows, activity = self.load_graph()
+        user_ids = [id for id, in db.session.query(User.id)]
+        for i in range(0, len(user_ids), batch_size):
+            self._call('replace_many', self.compute(follows, activity, user_ids[i:i + batch_size]))
+        return len(user_ids)
+
+    def rebuild(self, user):
+        """只计算一个用户的推荐，用于还没有推荐列表的用户"""
+        from app import db
+        from app.models import followers, Post
+        follows = {user.id: array('l', (id for id, in db.session.query(followers.c.followed_id).filter(
+            followers.c.follower_id == user.id)))}
+        if follows[user.id]:
+            for follower_id, followed_id in db.session.query(followers.c.follower_id, followers.c.followed_id) \
+                    .filter(followers.c.follower_id.in_(follows[user.id])):
+                follows.setdefault(follower_id, array('l')).append(followed_id)
+        candidates = {id for ids in follows.values() for id in ids}
+        activity = {user_id: self.activity(last_post) for user_id, last_post in db.session.query(
+            Post.user_id, db.func.max(Post.time_stamp)).filter(Post.user_id.in_(candidates))
+            .group_by(Post.user_id)} if candidates else {}
+        self._call('replace_many', self.compute(follows, activity, [user.id]))
+
+    def for_user(self, user, count):
+        """user的推荐用户列表，按得分排序，不含已经关注的人"""
+        from app.models import User
+        if not self._call('exists', user.id):
+            self.rebuild(user)
+        # 推荐列表可能还没有去掉刚关注的人，多取一些再过滤
+        ids = [id for id in self._call('top', user.id, count * 2) if id != user.id]
+        users = {u.id: u for u in User.query.filter(User.id.in_(ids))} if ids else {}
+        users = [users[id] for id in ids if id in users]
+        following = user.following_ids(users)
+        return [u for u in users if u.id not in following][:count]
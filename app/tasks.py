@@ -1,17 +1,22 @@
 import sys
 import time
 import json
+import os
+import gzip
+import glob
 
 from rq import get_current_job
 
 from app import create_app, db
-from app.models import Task, User, Post
+from app.models import User, Post, SearchOutbox
+from app.progress import TaskProgress
 from app.email import send_email
-from flask import render_template
+from flask import render_template, url_for
 
 
 app = create_app()
 app.app_context().push()
+app.language_detector.warm()
 
 
 def example(seconds):
@@ -27,38 +32,65 @@ def example(seconds):
     print('Task completed')
 
 
-def _set_task_progress(progress):
-    job = get_current_job()
-    if job:
-        job.meta['progress'] = progress
-        job.save_meta()
-        task = Task.query.get(job.get_id())
-        task.user.add_notification('task_progress', {'task_id': job.get_id(), 'progress': progress})
+def flush_last_seen():
+    """把缓冲的用户最后访问时间批量写入数据库"""
+    app.last_seen.flush()
+
+
+def index_search_outbox():
+    """把outbox中的变更批量写入搜索引擎"""
+    app.redis.delete('search:indexer-scheduled', 'search:indexer-retry')
+    try:
+        SearchOutbox.drain_all(app.config['SEARCH_INDEX_BATCH_SIZE'])
+    finally:
+        # 失败推迟的变更到期后自动重试
+        SearchOutbox.schedule_retry()
+    backlog = SearchOutbox.backlog()
+    app.logger.info('Search outbox: %d pending, lag %.1fs', backlog['pending'], backlog['lag'])
+
+
+def refresh_suggestions():
+    """重新计算所有用户的推荐关注"""
+    count = app.suggestions.refresh()
+    app.logger.info('Suggestions refreshed for %d users', count)
+
 
-        if progress >= 100:
-            task.complete = True
-        db.session.commit()
+def detect_post_languages(ids):
+    """识别新发布的post的语言"""
+    Post.detect_languages(ids)
 
 
 def export_posts(user_id):
+    """把用户的post逐行写入gzip压缩的NDJSON文件，邮件发送下载链接"""
+    progress = TaskProgress(get_current_job())
     try:
         user = User.query.get(user_id)
-        _set_task_progress(0)
-        data = []
-        i = 0
+        progress.update(0)
         total_posts = user.posts.count()
-        for post in user.posts.order_by(Post.time_stamp.asc()):
-            data.append({'body': post.body, 'time_stamp': post.time_stamp.isoformat()+ 'Z'})
-            time.sleep(2)
-            i += 1
-            _set_task_progress(100 * i // total_posts)
-        send_email('[Microblog] Your blog posts',
-                   sender=app.config['ADMINS'], recipients=[user.email],
-                   text_body=render_template('email/export_posts.txt', user=user),
-                   html_body=render_template('email/export_posts.html', user=user),
-                   attachments=[('posts.json', 'application/json', json.dumps(
-                       {'posts': data}, indent=4))],
-                   sync=True)
+        folder = app.config['EXPORT_FOLDER']
+        os.makedirs(folder, exist_ok=True)
+        User.remove_expired_exports()
+        filename = f'posts-{user.id}-{get_current_job().get_id()}.ndjson.gz'
+        path = os.path.join(folder, filename)
+        with gzip.open(path + '.part', 'wt', encoding='utf-8') as f:
+            for i, post in enumerate(user.export_posts(), 1):
+                f.write(json.dumps(post, ensure_ascii=False) + '\n')
+                progress.update(100 * i // total_posts)
+        os.replace(path + '.part', path)
+        # 只保留最新的一份导出
+        for old in glob.glob(os.path.join(folder, f'posts-{user.id}-*.ndjson.gz')):
+            if old != path:
+                os.remove(old)
+        token = user.get_export_token(filename, app.config['EXPORT_LINK_EXPIRES'])
+        with app.test_request_context(base_url=app.config['BASE_URL']):
+            url = url_for('main.download_export', token=token, _external=True)
+            send_email('[Microblog] Your blog posts',
+                       sender=app.config['ADMINS'], recipients=[user.email],
+                       text_body=render_template('email/export_posts.txt', user=user, url=url),
+                       html_body=render_template('email/export_posts.html', user=user, url=url),
+                       sync=True)
+        progress.update(100)
     except:
-        _set_task_progress(100)
+        db.session.rollback()
+        progress.fail()
         app.logger.error('Unhandled exception', exc_info=sys.exc_info())
\ No newline at end of file
@@ -0,0 +1,275 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime
+import redis
+from app.cache import after_commit
+from app.pagination import decode_cursor, keyset_paginate, KeysetPagination
+
+
+def _score(time_stamp):
+    return (time_stamp - datetime(1970, 1, 1)).total_seconds()
+
+
+class RedisTimelineBackend:
+    """每个用户一个有序集合，member为post id，score为发表时间
+
+    重建时设置过期时间，过期后从SQL重新建立，与数据库的偏差不会一直保留。
+    空的时间线另存一个同样会过期的标记，表示已经建立过。
+    """
+
+    def __init__(self, connection, size, ttl):
+        self.redis = connection
+        self.size = size
+        self.ttl = ttl
+
+    @staticmethod
+    def key(user_id):
+        return f'timeline:{user_id}'
+
+    @staticmethod
+    def empty_key(user_id):
+        return f'timeline:{user_id}:empty'
+
+    def exists(self, user_id):
+        return self.redis.exists(self.key(user_id), self.empty_key(user_id)) > 0
+
+    def replace(self, user_id, entries):
+        pipe = self.redis.pipeline()
+        pipe.delete(self.key(user_id), self.empty_key(user_id))
+        if entries:
+            pipe.zadd(self.key(user_id), {post_id: score for post_id, score in entries})
+            pipe.expire(self.key(user_id), self.ttl)
+        else:
+            pipe.set(self.empty_key(user_id), 1, ex=self.ttl)
+        pipe.execute()
+
+    def add(self, user_ids, entries):
+        # 只更新已建立的时间线，未建立的在读取时从SQL重建；空时间线的标记删除，读取时重建
+        pipe = self.redis.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.delete(self.empty_key(user_id))
+            pipe.exists(self.key(user_id))
+        user_ids = [user_id for user_id, found in zip(user_ids, pipe.execute()[1::2]) if found]
+        pipe = self.redis.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.zadd(self.key(user_id), {post_id: score for post_id, score in entries})
+            pipe.zremrangebyrank(self.key(user_id), 0, -self.size - 1)
+        pipe.execute()
+
+    def remove(self, user_ids, post_ids):
+        if post_ids:
+            pipe = self.redis.pipeline(transaction=False)
+            for user_id in user_ids:
+                pipe.zrem(self.key(user_id), *post_ids)
+            pipe.execute()
+
+    def discard(self, user_ids):
+        if user_ids:
+            self.redis.delete(*[key for user_id in user_ids
+                                for key in (self.key(user_id), self.empty_key(user_id))])
+
+    def range(self, user_id, start, stop):
+        ids = self.redis.zrevrange(self.key(user_id), start, stop - 1)
+        return [int(post_id) for post_id in ids]
+
+    def count(self, user_id):
+        return self.redis.zcard(self.key(user_id))
+
+    def range_after(self, user_id, score, post_id, count, older=True):
+        # 与边界score相同的post按id比较，其余按score排除
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zrangebyscore(self.key(user_id), score, score)
+        if older:
+            pipe.zrevrangebyscore(self.key(user_id), f'({score!r}', '-inf', start=0, num=count)
+        else:
+            pipe.zrangebyscore(self.key(user_id), f'({score!r}', '+inf', start=0, num=count)
+        ties, rest = pipe.execute()
+        ties = sorted((int(i) for i in ties if (int(i) < post_id if older else int(i) > post_id)),
+                      reverse=older)
+        return (ties + [int(i) for i in rest])[:count]
+
+
+class MemoryTimelineBackend:
+    """Redis不可用时的进程内实现，按(score, id)倒序保存，最多保存max_users个最近使用的用户"""
+
+    def __init__(self, size, max_users):
+        self.size = size
+        self.max_users = max_users
+        self.timelines = OrderedDict()
+        self.lock = threading.Lock()
+
+    def exists(self, user_id):
+        return user_id in self.timelines
+
+    def replace(self, user_id, entries):
+        timeline = sorted(((score, post_id) for post_id, score in entries), reverse=True)[:self.size]
+        with self.lock:
+            self.timelines[user_id] = timeline
+            self.timelines.move_to_end(user_id)
+            while len(self.timelines) > self.max_users:
+                self.timelines.popitem(last=False)
+
+    def add(self, user_ids, entries):
+        for user_id in user_ids:
+            if user_id not in self.timelines:
+                continue
+            timeline = dict((post_id, score) for score, post_id in self.timelines.get(user_id, []))
+            timeline.update(entries)
+            self.replace(user_id, list(timeline.items()))
+
+    def remove(self, user_ids, post_ids):
+        post_ids = set(post_ids)
+        for user_id in user_ids:
+            if user_id in self.timelines:
+                self.replace(user_id, [(post_id, score) for score, post_id in self.timelines[user_id]
+                                       if post_id not in post_ids])
+
+    def discard(self, user_ids):
+        with self.lock:
+            for user_id in user_ids:
+                self.timelines.pop(user_id, None)
+
+    def range(self, user_id, start, stop):
+        with self.lock:
+            if user_id in self.timelines:
+                self.timelines.move_to_end(user_id)
+        return [post_id for score, post_id in self.timelines.get(user_id, [])[start:stop]]
+
+    def count(self, user_id):
+        return len(self.timelines.get(user_id, []))
+
+    def range_after(self, user_id, score, post_id, count, older=True):
+        timeline = self.timelines.get(user_id, [])
+        if older:
+            return [i for s, i in timeline if (s, i) < (score, post_id)][:count]
+        return [i for s, i in reversed(timeline) if (s, i) > (score, post_id)][:count]
+
+
+class Timeline:
+    """首页动态的写扩散缓存
+
+    发表post时把id推送到作者及其粉丝的时间线中，删除post时移除，关注时回填，取消关注时清理。
+    缓存未建立或请求超出缓存长度时，回退到User.followed_posts()的SQL查询。
+    """
+
+    def __init__(self, app=None):
+        self.redis_backend = None
+        self.memory_backend = None
+        # Redis不可用期间写入了进程内实现的用户，Redis恢复后删除他们在Redis中的时间线
+        self.stale = set()
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        size = app.config['TIMELINE_SIZE']
+        self.redis_backend = RedisTimelineBackend(app.redis, size, app.config['TIMELINE_TTL'])
+        self.memory_backend = MemoryTimelineBackend(size, app.config['TIMELINE_MEMORY_USERS'])
+        self.size = size
+
+    def _call(self, method, *args, **kwargs):
+        try:
+            if self.stale:
+                self._discard_stale()
+            return getattr(self.redis_backend, method)(*args, **kwargs)
+        except redis.exceptions.RedisError:
+            if method in ('add', 'remove', 'discard'):
+                self._mark_stale(args[0])
+            elif method == 'replace':
+                self._mark_stale([args[0]])
+            return getattr(self.memory_backend, method)(*args, **kwargs)
+
+    def _mark_stale(self, user_ids):
+        with self.lock:
+            self.stale.update(user_ids)
+
+    def _discard_stale(self):
+        with self.lock:
+            stale, self.stale = self.stale, set()
+        try:
+            self.redis_backend.discard(list(stale))
+        except redis.exceptions.RedisError:
+            self._mark_stale(stale)
+            raise
+
+    def push(self, session, post, user_ids):
+        """post提交后推送到给定用户(作者和粉丝)的时间线"""
+        after_commit(session, self._call, 'add', list(user_ids), [(post.id, _score(post.time_stamp))])
+
+    def pull(self, session, post_ids, user_ids):
+        """post删除提交后从给定用户(作者和粉丝)的时间线中移除，避免分页时按已删除的id计数"""
+        after_commit(session, self._call, 'remove', list(user_ids), list(post_ids))
+
+    def follow(self, session, user, followed):
+        """user关注followed后，把followed最近的post回填到user的时间线"""
+        from app.models import Post
+        entries = [(post_id, _score(time_stamp)) for post_id, time_stamp in
+                   Post.query.with_entities(Post.id, Post.time_stamp).filter_by(
+                       user_id=followed.id).order_by(Post.time_stamp.desc()).limit(self.size)]
+        if entries:
+            after_commit(session, self._call, 'add', [user.id], entries)
+
+    def unfollow(self, session, user, followed):
+        """user取消关注followed后，从user的时间线中移除followed的post"""
+        from app.models import Post
+        ids = self._call('range', user.id, 0, self.size)
+        if not ids:
+            return
+        post_ids = [post_id for post_id, in Post.query.with_entities(Post.id).filter(
+            Post.id.in_(ids), Post.user_id == followed.id)]
+        if post_ids:
+            after_commit(session, self._call, 'remove', [user.id], post_ids)
+
+    def discard(self, user_ids):
+        """删除这些用户的时间线缓存，下次读取时从SQL重建，用于批量导入等绕过ORM的写入"""
+        self._call('discard', list(user_ids))
+
+    def rebuild(self, user):
+        """从SQL重建user的时间线"""
+        entries = [(post.id, _score(post.time_stamp))
+                   for post in user.followed_posts().limit(self.size)]
+        self._call('replace', user.id, entries)
+        return entries
+
+    def page(self, user, page, per_page):
+        """返回第page页的post列表和是否还有下一页"""
+        start = (page - 1) * per_page
+        stop = start + per_page + 1
+        if not self._call('exists', user.id):
+            self.rebuild(user)
+        count = self._call('count', user.id)
+        if count >= self.size and stop > count:
+            # 超出缓存长度，走SQL
+            posts = user.followed_posts().paginate(page, per_page, False)
+            return posts.items, posts.has_next
+        ids = self._call('range', user.id, start, stop)
+        has_next = len(ids) > per_page
+        return self._hydrate(ids[:per_page]), has_next
+
+    def keyset(self, user, cursor, per_page):
+        """按游标读取user的时间线，返回KeysetPagination"""
+        from app.models import Post
+        columns = (Post.time_stamp, Post.id)
+        direction, values = decode_cursor(cursor, columns) if cursor else ('next', None)
+        if not self._call('exists', user.id):
+            self.rebuild(user)
+        if values is None:
+            ids = self._call('range', user.id, 0, per_page + 1)
+        else:
+            ids = self._call('range_after', user.id, _score(values[0]), values[1],
+                             per_page + 1, direction == 'next')
+        if direction == 'next' and len(ids) <= per_page and \
+                self._call('count', user.id) >= self.size:
+            # 超出缓存长度，走SQL
+            return keyset_paginate(user.followed_posts(), columns, cursor, per_page)
+        has_more = len(ids) > per_page
+        ids = ids[:per_page]
+        if direction == 'prev':
+            ids.reverse()
+        return KeysetPagination(self._hydrate(ids), columns, direction, has_more, values is not None)
+
+    @staticmethod
+    def _hydrate(ids):
+        from app.models import Post
+        posts = {post.id: post for post in Post.query.filter(Post.id.in_(ids))} if ids else {}
+        return [posts[post_id] for post_id in ids if post_id in posts]
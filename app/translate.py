@@ -1,42 +1,150 @@
-import json
+import threading
 import requests
 from flask_babel import _
 from flask import current_app
 from time import time
-from hashlib import md5
+from hashlib import md5, sha256
 
 
-translate_url = 'http://api.fanyi.baidu.com/api/trans/vip/translate'
+# 处理识别语言和翻译语言之间国家语言代码不同的问题
+LANGUAGE_CODES = {'ja': 'jp'}
 
 
-def translate(text, source_language, dest_language):
+class CircuitBreaker:
+    """连续失败达到阈值后断开一段时间，期间直接返回错误，不再请求翻译服务"""
 
-    if ('BDKEY' not in current_app.config or not current_app.config['BDKEY']) or \
-            ('BDAPPID' not in current_app.config or not current_app.config['BDAPPID']):
-        return _('Error: the translation service is not configured.')
-    salt = str(int(time()))
-    string = current_app.config['BDAPPID'] + text + salt + current_app.config['BDKEY']
-    # string = '2015063000000001apple143566028812345678'
-    sign = md5(string.encode('utf-8')).hexdigest()
-    # 处理识别语言和翻译语言之间国家语言代码不同的问题
-    lang = {'ja': 'jp'}
-    source_language = lang.get(source_language) or source_language
-    # print(source_language, dest_language, text)
-    args = {
-        'q': text,
-        'from': source_language,
-        'to': dest_language,
-        'appid': current_app.config['BDAPPID'],
-        'salt': salt,
-        'sign': sign
-    }
-    result = requests.get(translate_url, params=args).json()
-    if 'error_code' in result:
-        return _('Error: %(error_msg)s', error_msg=result['error_msg'])
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            # 断开时间到了之后放行请求试探服务是否恢复
+            return self.opened_at is None or time() - self.opened_at >= self.reset_timeout
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time()
+
+
+class TranslationError(Exception):
+    pass
 
-    return result['trans_result'][0]['dst']
 
+class Translator:
+    """共用一个保持连接的requests.Session调用百度翻译，多段文本按行合并为一次请求"""
 
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
 
+    def init_app(self, app):
+        self.url = app.config['TRANSLATE_URL']
+        self.timeout = app.config['TRANSLATE_TIMEOUT']
+        self.batch_bytes = app.config['TRANSLATE_BATCH_BYTES']
+        self.breaker = CircuitBreaker(app.config['TRANSLATE_BREAKER_THRESHOLD'],
+                                      app.config['TRANSLATE_BREAKER_RESET'])
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=app.config['TRANSLATE_POOL_SIZE'])
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
+    def request(self, texts, source_language, dest_language):
+        """一次请求翻译多行文本，返回与texts对应的译文列表"""
+        if not self.breaker.allow():
+            raise TranslationError(_('the translation service is unavailable'))
+        q = '\n'.join(texts)
+        salt = str(int(time()))
+        sign = md5((current_app.config['BDAPPID'] + q + salt + current_app.config['BDKEY'])
+                   .encode('utf-8')).hexdigest()
+        args = {
+            'q': q,
+            'from': source_language,
+            'to': dest_language,
+            'appid': current_app.config['BDAPPID'],
+            'salt': salt,
+            'sign': sign
+        }
+        try:
+            response = self.session.post(self.url, data=args, timeout=self.timeout)
+            response.raise_for_status()
+            result = response.json()
+        except (requests.RequestException, ValueError) as e:
+            self.breaker.failure()
+            raise TranslationError(str(e))
+        self.breaker.success()
+        if 'error_code' in result:
+            raise TranslationError(result['error_msg'])
+        translations = [item['dst'] for item in result['trans_result']]
+        if len(texts) == 1:
+            # 多行文本单独请求，各行的译文重新合并
+            return ['\n'.join(translations)]
+        if len(translations) != len(texts):
+            raise TranslationError('unexpected number of translations')
+        return translations
 
+    def batches(self, texts):
+        """按请求大小上限分组；含换行的文本会被拆成多行，单独请求"""
+        batch, size = [], 0
+        for i, text in enumerate(texts):
+            length = len(text.encode('utf-8')) + 1
+            if '\n' in text:
+                yield [i]
+                continue
+            if batch and size + length > self.batch_bytes:
+                yield batch
+                batch, size = [], 0
+            batch.append(i)
+            size += length
+        if batch:
+            yield batch
+
+
+def translate_many(items):
+    """翻译多段文本，items为[(原文, 源语言, 目标语言)]，按顺序返回译文或错误信息
+
+    先查缓存，未命中的按(源语言, 目标语言)分组，合并成尽量少的请求。
+    """
+    if ('BDKEY' not in current_app.config or not current_app.config['BDKEY']) or \
+            ('BDAPPID' not in current_app.config or not current_app.config['BDAPPID']):
+        return [_('Error: the translation service is not configured.')] * len(items)
+    results = [None] * len(items)
+    groups = {}
+    for i, (text, source_language, dest_language) in enumerate(items):
+        source_language = LANGUAGE_CODES.get(source_language) or source_language
+        key = f'{sha256(text.encode("utf-8")).hexdigest()}:{source_language}:{dest_language}'
+        results[i] = current_app.translation_cache.get(key)
+        if results[i] is None:
+            groups.setdefault((source_language, dest_language), {}).setdefault(text, (key, []))[1].append(i)
+    translator = current_app.translator
+    for (source_language, dest_language), pending in groups.items():
+        texts = list(pending)
+        for batch in translator.batches(texts):
+            try:
+                translations = translator.request([texts[i] for i in batch], source_language, dest_language)
+            except TranslationError as e:
+                translations = None
+                error = _('Error: %(error_msg)s', error_msg=str(e))
+            for n, i in enumerate(batch):
+                key, positions = pending[texts[i]]
+                if translations is not None:
+                    # 出错时不缓存
+                    current_app.translation_cache.set(key, translations[n])
+                for position in positions:
+                    results[position] = translations[n] if translations is not None else error
+    return results
+
+
+def translate(text, source_language, dest_language):
+    """翻译结果按(原文摘要, 源语言, 目标语言)缓存，出错时不缓存"""
+    return translate_many([(text, source_language, dest_language)])[0]
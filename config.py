@@ -17,14 +17,81 @@ class Config:
     MAIL_USE_SSL = os.environ.get('MAIL_USE_SSL') is not None
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
+    # 后台发送邮件的队列容量、每个SMTP连接发送的封数、每秒最多发送的封数、失败重试次数和初始间隔(秒)
+    MAIL_QUEUE_SIZE = 1000
+    MAIL_BATCH_SIZE = 50
+    MAIL_RATE_LIMIT = 10
+    MAIL_MAX_RETRIES = 3
+    MAIL_RETRY_BACKOFF = 2
     # 每页显示的数据
     POSTS_PER_PAGE = 10
+    # 默认使用游标分页(不传page参数时)
+    CURSOR_PAGINATION = os.environ.get('CURSOR_PAGINATION') is not None
+    # 首页时间线缓存的最大长度，Redis中时间线的有效期(秒)，Redis不可用时进程内最多缓存的用户数
+    TIMELINE_SIZE = 800
+    TIMELINE_TTL = 24 * 3600
+    TIMELINE_MEMORY_USERS = 10000
     # 支持的语言
     LANGUAGES = ['zh', 'en']
     BDAPPID = os.environ.get('BDAPPID')
     BDKEY = os.environ.get('BDKEY')
+    TRANSLATE_URL = os.environ.get('TRANSLATE_URL') or 'http://api.fanyi.baidu.com/api/trans/vip/translate'
+    # 翻译请求的连接和读取超时(秒)，单次请求的最大字节数，连接池大小
+    TRANSLATE_TIMEOUT = (3.05, 10)
+    TRANSLATE_BATCH_BYTES = 5000
+    TRANSLATE_POOL_SIZE = 10
+    # 连续失败多少次后暂停请求翻译服务，以及暂停的时间(秒)
+    TRANSLATE_BREAKER_THRESHOLD = 5
+    TRANSLATE_BREAKER_RESET = 30
+    # 任务进度至少变化多少(百分比)或间隔多少秒才上报一次
+    TASK_PROGRESS_STEP = 5
+    TASK_PROGRESS_INTERVAL = 2
+    # 每个用户保存的推荐关注人数，活跃度加分减半的天数
+    SUGGESTIONS_SIZE = 50
+    SUGGESTIONS_ACTIVITY_HALF_LIFE = 7
+    # 没有候选的用户记为已计算的有效期(秒)，过期后读取时重新计算
+    SUGGESTIONS_EMPTY_TTL = 3600
+    # Redis不可用时进程内最多缓存推荐列表的用户数
+    SUGGESTIONS_MEMORY_USERS = 10000
+    # 导出文件的保存目录，下载链接的有效期(秒)，邮件中链接使用的网站地址
+    EXPORT_FOLDER = os.environ.get('EXPORT_FOLDER') or os.path.join(basedir, 'exports')
+    EXPORT_LINK_EXPIRES = 7 * 24 * 3600
+    BASE_URL = os.environ.get('BASE_URL') or 'http://localhost:5000'
+    # 短于此长度的post不识别语言
+    LANGUAGE_DETECTION_MIN_LENGTH = 8
+    # 翻译结果缓存的有效期(秒)和进程内缓存容量
+    TRANSLATION_CACHE_TTL = 7 * 24 * 3600
+    TRANSLATION_CACHE_SIZE = 10000
     # 邮件发送者
     ADMINS = os.environ.get('ADMINS')
 
     REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
+    # 配置了Elasticsearch时使用它，否则使用基于SQLite FTS5的内置搜索引擎
+    ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    SEARCH_DATABASE = os.environ.get('SEARCH_DATABASE') or os.path.join(basedir, 'search.db')
+    # 搜索索引每批写入的条数和失败重试的最长间隔(秒)
+    SEARCH_INDEX_BATCH_SIZE = 500
+    SEARCH_INDEX_MAX_BACKOFF = 300
+    # 无法安排RQ任务(Redis不可用)时，每次提交后在当前进程中直接处理的outbox条数
+    SEARCH_INLINE_BATCH_SIZE = 100
+    # 搜索结果缓存：每个查询缓存前若干个排好序的id供翻页使用，有效期(秒)和进程内缓存容量
+    SEARCH_CACHE_WINDOW = 200
+    SEARCH_CACHE_TTL = 60
+    SEARCH_CACHE_SIZE = 1000
+    # Redis不可用时进程内API令牌缓存的容量
+    TOKEN_CACHE_SIZE = 10000
+    # 密码哈希方法(含迭代次数)，修改后用户下次登录时自动按新方法重新计算
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256:260000'
+    # 计算密码哈希的进程数(0为在请求线程中计算)和最多排队的校验数，超过时返回503
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 2)
+    PASSWORD_HASH_QUEUE_SIZE = 32
+    # 校验成功的密码的缓存有效期(秒)和Redis不可用时进程内缓存的容量
+    CREDENTIAL_CACHE_TTL = 300
+    CREDENTIAL_CACHE_SIZE = 10000
+    # 用户最后访问时间写入数据库的间隔(秒)，间隔内的重复访问不再记录
+    LAST_SEEN_INTERVAL = int(os.environ.get('LAST_SEEN_INTERVAL') or 60)
+    LAST_SEEN_BUFFER_SIZE = 10000
+    # 通知流每个连接保持的时间和心跳间隔(秒)，断开后浏览器自动重连
+    NOTIFICATION_STREAM_TIMEOUT = int(os.environ.get('NOTIFICATION_STREAM_TIMEOUT') or 60)
+    NOTIFICATION_STREAM_HEARTBEAT = 15
 
@@ -1,5 +1,5 @@
 from app import create_app, db, cli
-from app.models import User, Post, Message, Notification, Task
+from app.models import User, Post, Message, Notification, Task, SearchOutbox
 
 app = create_app()
 cli.register(app)
@@ -8,5 +8,5 @@ cli.register(app)
 @app.shell_context_processor
 def make_shell_context():
     return {'db': db, 'User': User, 'Post': Post, 'Message': Message,
-            'Notification': Notification, 'Task': Task}
+            'Notification': Notification, 'Task': Task, 'SearchOutbox': SearchOutbox}
 
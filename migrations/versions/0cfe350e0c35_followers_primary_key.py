@@ -0,0 +1,46 @@
+"""followers primary key
+
+Revision ID: 0cfe350e0c35
+Revises: 41bab3df04fd
+Create Date: 2026-10-18 04:42:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0cfe350e0c35'
+down_revision = '41bab3df04fd'
+branch_labels = None
+depends_on = None
+
+
+def _copy_followers(primary_key):
+    """用新结构重建followers表，重复和不完整的关注关系在复制时去掉"""
+    op.create_table('followers_new',
+    sa.Column('follower_id', sa.Integer(), nullable=not primary_key),
+    sa.Column('followed_id', sa.Integer(), nullable=not primary_key),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], ),
+    *([sa.PrimaryKeyConstraint('follower_id', 'followed_id')] if primary_key else [])
+    )
+    op.execute('INSERT INTO followers_new (follower_id, followed_id) '
+               'SELECT DISTINCT follower_id, followed_id FROM followers '
+               'WHERE follower_id IS NOT NULL AND followed_id IS NOT NULL')
+    op.drop_table('followers')
+    op.rename_table('followers_new', 'followers')
+
+
+def upgrade():
+    _copy_followers(primary_key=True)
+    op.create_index(op.f('ix_followers_followed_id'), 'followers', ['followed_id'], unique=False)
+    # 去掉重复的关注关系后重新计算关注数
+    op.execute('UPDATE "user" SET '
+               'follower_count = (SELECT count(*) FROM followers WHERE followers.followed_id = "user".id), '
+               'followed_count = (SELECT count(*) FROM followers WHERE followers.follower_id = "user".id)')
+
+
+def downgrade():
+    op.drop_index(op.f('ix_followers_followed_id'), table_name='followers')
+    _copy_followers(primary_key=False)
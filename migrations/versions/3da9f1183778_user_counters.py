@@ -0,0 +1,42 @@
+"""user counters
+
+Revision ID: 3da9f1183778
+Revises: c83ca5816cf4
+Create Date: 2026-10-18 04:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3da9f1183778'
+down_revision = 'c83ca5816cf4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('post_count', sa.Integer(), server_default='0', nullable=True))
+    op.add_column('user', sa.Column('follower_count', sa.Integer(), server_default='0', nullable=True))
+    op.add_column('user', sa.Column('followed_count', sa.Integer(), server_default='0', nullable=True))
+    op.add_column('user', sa.Column('unread_message_count', sa.Integer(), server_default='0', nullable=True))
+    # 按现有数据回填计数，之后也可以用flask counters repair修复
+    op.execute('UPDATE "user" SET '
+               'post_count = (SELECT count(*) FROM post WHERE post.user_id = "user".id), '
+               'follower_count = (SELECT count(*) FROM followers WHERE followers.followed_id = "user".id), '
+               'followed_count = (SELECT count(*) FROM followers WHERE followers.follower_id = "user".id)')
+    bind = op.get_bind()
+    if sa.inspect(bind).has_table('message') and \
+            'last_message_read_time' in [c['name'] for c in sa.inspect(bind).get_columns('user')]:
+        op.execute('UPDATE "user" SET unread_message_count = (SELECT count(*) FROM message '
+                   'WHERE message.recipient_id = "user".id AND message.time_stamp > '
+                   'coalesce("user".last_message_read_time, \'1999-01-01\'))')
+
+
+def downgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_column('unread_message_count')
+        batch_op.drop_column('followed_count')
+        batch_op.drop_column('follower_count')
+        batch_op.drop_column('post_count')
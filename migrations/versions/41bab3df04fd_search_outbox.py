@@ -0,0 +1,35 @@
+"""search outbox
+
+Revision ID: 41bab3df04fd
+Revises: 3da9f1183778
+Create Date: 2026-10-18 04:41:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '41bab3df04fd'
+down_revision = '3da9f1183778'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('search_outbox',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('index', sa.String(length=64), nullable=True),
+    sa.Column('object_id', sa.Integer(), nullable=True),
+    sa.Column('operation', sa.String(length=8), nullable=True),
+    sa.Column('time_stamp', sa.Float(), nullable=True),
+    sa.Column('attempts', sa.Integer(), nullable=True),
+    sa.Column('next_attempt', sa.Float(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_search_outbox_next_attempt'), 'search_outbox', ['next_attempt'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_search_outbox_next_attempt'), table_name='search_outbox')
+    op.drop_table('search_outbox')
@@ -1,13 +1,174 @@
 from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+import base64
+import gzip
+import json
+import os
+import socketserver
+import tempfile
+import threading
+import time
 import unittest
-from app import create_app, db
-from app.models import User, Post
+import redis
+from unittest import mock
+from werkzeug.security import generate_password_hash
+from app import create_app, db, cli
+from app.models import User, Post, Message, SearchOutbox, Task, token_digest
+from app.pagination import keyset_paginate
+from app.passwords import PasswordHasher, PasswordHasherBusy
+from app.progress import TaskProgress
+from app.email import send_email
+from app.search import switch_index, tokenize
+from app.suggestions import RedisSuggestionBackend, MemorySuggestionBackend
+from app.timeline import RedisTimelineBackend, MemoryTimelineBackend
+from app.translate import translate
 from config import Config
 
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    ELASTICSEARCH_URL = None
+    SEARCH_DATABASE = ':memory:'
+    PASSWORD_HASH_WORKERS = 0
+
+
+class TranslateStub(ThreadingHTTPServer):
+    """本地的百度翻译替身，每行译文为"[目标语言] 原文"，记录收到的请求"""
+
+    def __init__(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                form = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+                args = {key: value[0] for key, value in form.items()}
+                stub.requests.append(args)
+                if stub.error:
+                    result = {'error_code': '54003', 'error_msg': stub.error}
+                else:
+                    result = {'trans_result': [{'src': line, 'dst': f'[{args["to"]}] {line}'}
+                                               for line in args['q'].split('\n')]}
+                body = json.dumps(result).encode('utf-8')
+                self.send_response(stub.status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.requests = []
+        self.error = None
+        self.status = 200
+        self.url = f'http://127.0.0.1:{self.server_port}/'
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def __exit__(self, *args):
+        self.shutdown()
+        super().__exit__(*args)
+
+
+class SMTPStub(socketserver.ThreadingTCPServer):
+    """本地的SMTP替身，记录收到的邮件和连接数，fail_next次DATA返回临时错误"""
+
+    daemon_threads = True
+
+    def __init__(self):
+        stub = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write(line.encode('ascii') + b'\r\n')
+
+            def handle(self):
+                stub.connections += 1
+                self.reply('220 stub')
+                for line in self.rfile:
+                    command = line.decode('utf-8').strip().upper()
+                    if command.startswith('DATA'):
+                        self.reply('354 go ahead')
+                        data = b''.join(iter(lambda: self.rfile.readline(), b'.\r\n'))
+                        if stub.fail_next:
+                            stub.fail_next -= 1
+                            self.reply('451 try again later')
+                        else:
+                            stub.messages.append(data)
+                            self.reply('250 ok')
+                    elif command.startswith('QUIT'):
+                        self.reply('221 bye')
+                        break
+                    else:
+                        self.reply('250 ok')
+
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.messages = []
+        self.connections = 0
+        self.fail_next = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def __exit__(self, *args):
+        self.shutdown()
+        super().__exit__(*args)
+
+
+class RedisStub:
+    """只实现Redis后端用到的几个命令，记录过期时间但不会过期"""
+
+    def __init__(self):
+        self.data = {}
+        self.ttl = {}
+
+    def pipeline(self, transaction=True):
+        stub = self
+
+        class Pipeline:
+            def __init__(self):
+                self.calls = []
+
+            def __getattr__(self, name):
+                return lambda *args, **kwargs: self.calls.append((name, args, kwargs))
+
+            def execute(self):
+                return [getattr(stub, name)(*args, **kwargs) for name, args, kwargs in self.calls]
+
+        return Pipeline()
+
+    def exists(self, *keys):
+        return sum(key in self.data for key in keys)
+
+    def delete(self, *keys):
+        for key in keys:
+            self.ttl.pop(key, None)
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        self.ttl[key] = ex
+        return True
+
+    def expire(self, key, seconds):
+        if key in self.data:
+            self.ttl[key] = seconds
+
+    def zadd(self, key, mapping):
+        self.data.setdefault(key, {}).update({int(member): score for member, score in mapping.items()})
+
+    def zrem(self, key, *members):
+        for member in members:
+            self.data.get(key, {}).pop(int(member), None)
+
+    def zcard(self, key):
+        return len(self.data.get(key, {}))
+
+    def zrevrange(self, key, start, stop):
+        members = sorted(self.data.get(key, {}).items(), key=lambda item: (item[1], item[0]), reverse=True)
+        return [str(member).encode() for member, _ in members[start:stop + 1 if stop >= 0 else None]]
 
 
 class UserModerCase(unittest.TestCase):
@@ -96,6 +257,794 @@ class UserModerCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_timeline(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        now = datetime.utcnow()
+        p1 = Post(body="post from john", author=u1,
+                  time_stamp=now + timedelta(seconds=1))
+        p2 = Post(body="post from susan", author=u2,
+                  time_stamp=now + timedelta(seconds=2))
+        db.session.add_all([p1, p2])
+        db.session.commit()
+
+        # 首次读取从SQL重建
+        self.assertEqual(u1.timeline(1, 10), ([p1], False))
+
+        # 关注时回填，新post推送给粉丝
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual(u1.timeline(1, 10), ([p2, p1], False))
+        p3 = Post(body="another post from susan", author=u2,
+                  time_stamp=now + timedelta(seconds=3))
+        db.session.add(p3)
+        db.session.commit()
+        self.assertEqual(u1.timeline(1, 2), ([p3, p2], True))
+        self.assertEqual(u1.timeline(2, 2), ([p1], False))
+        self.assertEqual(u1.timeline(1, 10)[0], u1.followed_posts().all())
+
+        # 取消关注时清理
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u1.timeline(1, 10), ([p1], False))
+
+        # Redis中空的时间线也记为已建立，时间线都有过期时间
+        timeline = self.app.timeline
+        stub = RedisStub()
+        timeline.redis_backend = RedisTimelineBackend(stub, timeline.size, 60)
+        u3 = User(username='david', email='david@example.com')
+        db.session.add(u3)
+        db.session.commit()
+        with mock.patch.object(timeline, 'rebuild', wraps=timeline.rebuild) as rebuild:
+            self.assertEqual(u3.timeline(1, 10), ([], False))
+            self.assertEqual(u3.timeline(1, 10), ([], False))
+        self.assertEqual(rebuild.call_count, 1)
+        self.assertEqual(stub.ttl[f'timeline:{u3.id}:empty'], 60)
+        u3.follow(u2)
+        db.session.commit()
+        self.assertEqual(u3.timeline(1, 10), ([p3, p2], False))
+        self.assertEqual(stub.ttl[f'timeline:{u3.id}'], 60)
+
+        # Redis写入失败的时间线在Redis恢复后删除，读取时从SQL重建
+        with mock.patch.object(stub, 'pipeline', side_effect=redis.exceptions.ConnectionError):
+            p4 = Post(body="post during an outage", author=u2, time_stamp=now + timedelta(seconds=4))
+            db.session.add(p4)
+            db.session.commit()
+        self.assertEqual(timeline.stale, {u2.id, u3.id})
+        self.assertEqual(u3.timeline(1, 10), ([p4, p3, p2], False))
+        self.assertEqual(timeline.stale, set())
+
+        # 删除的post从时间线中移除，分页不会变短
+        db.session.delete(p3)
+        db.session.commit()
+        self.assertEqual(u3.timeline(1, 2), ([p4, p2], False))
+        self.assertEqual(u2.timeline(1, 2), ([p4, p2], False))
+
+        # 进程内实现只保存最近使用的用户
+        memory = MemoryTimelineBackend(10, 2)
+        for user_id in (1, 2):
+            memory.replace(user_id, [(user_id, 0)])
+        memory.range(1, 0, 10)
+        memory.replace(3, [])
+        self.assertEqual((memory.exists(1), memory.exists(2), memory.exists(3)), (True, False, True))
+
+    def test_keyset_pagination(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        u1.follow(u2)
+        now = datetime.utcnow()
+        # 时间相同的post跨页，靠id区分先后
+        posts = [Post(body=f"post {i}", author=[u1, u2][i % 2],
+                      time_stamp=now + timedelta(seconds=s)) for i, s in enumerate([0, 1, 1, 1, 2])]
+        db.session.add_all(posts)
+        db.session.commit()
+        expected = u1.followed_posts().order_by(None).order_by(
+            Post.time_stamp.desc(), Post.id.desc()).all()
+
+        for paginate in (u1.timeline_keyset,
+                         lambda c, n: keyset_paginate(u1.followed_posts(), (Post.time_stamp, Post.id), c, n)):
+            page1 = paginate('', 2)
+            self.assertEqual(page1.items, expected[:2])
+            self.assertFalse(page1.has_prev)
+            page2 = paginate(page1.next_cursor, 2)
+            self.assertEqual(page2.items, expected[2:4])
+            page3 = paginate(page2.next_cursor, 2)
+            self.assertEqual(page3.items, expected[4:])
+            self.assertFalse(page3.has_next)
+            back = paginate(page3.prev_cursor, 2)
+            self.assertEqual(back.items, expected[2:4])
+            back = paginate(back.prev_cursor, 2)
+            self.assertEqual(back.items, expected[:2])
+            self.assertFalse(back.has_prev)
+        self.assertRaises(ValueError, u1.timeline_keyset, 'bogus', 2)
+
+    def test_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        u1.follow(u2)
+        db.session.commit()
+        u1.follow(u3)
+        u3.follow(u2)
+        p1 = Post(body="post from john", author=u1)
+        p2 = Post(body="another post from john", author=u1)
+        db.session.add_all([p1, p2])
+        db.session.commit()
+        self.assertEqual((u1.post_count, u1.followed_count, u1.follower_count), (2, 2, 0))
+        self.assertEqual((u2.post_count, u2.followed_count, u2.follower_count), (0, 0, 2))
+
+        u1.unfollow(u2)
+        db.session.delete(p1)
+        db.session.commit()
+        self.assertEqual((u1.post_count, u1.followed_count), (1, 1))
+        self.assertEqual(u2.follower_count, 1)
+        self.assertEqual(User.repair_counters(), 0)
+
+        u2.follower_count = 5
+        u3.post_count = None
+        db.session.commit()
+        self.assertEqual(User.repair_counters(), 2)
+        self.assertEqual((u2.follower_count, u3.post_count), (1, 0))
+
+    def test_collection_query_count(self):
+        users = [User(username=f'user{i}', email=f'user{i}@example.com') for i in range(10)]
+        db.session.add_all(users)
+        for user in users[1:]:
+            users[0].follow(user)
+        db.session.commit()
+
+        statements = []
+        db.event.listen(db.engine, 'before_cursor_execute',
+                        lambda *args: statements.append(args[2]))
+        with self.app.test_request_context():
+            counts = []
+            for per_page in (2, 10):
+                del statements[:]
+                data = User.to_collection_dict(User.query, 1, per_page, 'api.get_users')
+                counts.append(len(statements))
+            self.assertEqual(counts[0], counts[1])
+            self.assertEqual(data['items'][0], users[0].to_dict())
+            self.assertEqual(data['items'][0]['followed_count'], 9)
+            self.assertEqual(data['items'][1]['_links']['followers'], '/api/users/2/followers')
+
+            # 带上是否关注时每页只多一次查询
+            counts = []
+            for per_page in (2, 10):
+                del statements[:]
+                data = User.to_collection_dict(User.query, 1, per_page, 'api.get_users',
+                                               options={'viewer': users[0]})
+                counts.append(len(statements))
+            self.assertEqual(counts[0], counts[1])
+            self.assertEqual([item['is_following'] for item in data['items']], [False] + [True] * 9)
+
+    def test_token_cache(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        token = u.get_token()
+        db.session.commit()
+        user_id = u.id
+
+        statements = []
+        db.event.listen(db.engine, 'before_cursor_execute',
+                        lambda *args: statements.append(args[2]))
+        self.assertEqual(User.check_token_id(token), user_id)
+        self.assertEqual(statements, [])
+
+        expiration = u.token_expiration
+        u.revoke_token()
+        # 提交前另一个请求从数据库读到旧的有效期并重新写入缓存，提交后仍会被清除
+        User.cache_token(token, user_id, expiration)
+        db.session.commit()
+        self.assertIsNone(self.app.token_cache.get(token_digest(token)))
+        self.assertIsNone(User.check_token_id(token))
+        self.assertIsNone(User.check_token(token))
+        self.assertIsNone(User.check_token('bogus'))
+
+        # 令牌仍在缓存中但用户已被删除时返回401，并清除缓存
+        token = u.get_token()
+        db.session.commit()
+        db.session.execute(User.__table__.delete().where(User.id == user_id))
+        db.session.commit()
+        db.session.expunge_all()
+        client = self.app.test_client()
+        response = client.get('/api/timeline', headers={'Authorization': f'Bearer {token}'})
+        self.assertEqual(response.status_code, 401)
+        self.assertIsNone(self.app.token_cache.get(token_digest(token)))
+
+    def test_last_seen_buffer(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        later = datetime.utcnow() + timedelta(days=1)
+
+        buffer = self.app.last_seen
+        self.assertTrue(buffer.touch(u1.id, later))
+        self.assertFalse(buffer.touch(u1.id, later + timedelta(seconds=1)))
+        self.assertTrue(buffer.touch(u2.id, later))
+        self.assertEqual(buffer.maybe_flush(), 0)
+        self.assertEqual(buffer.flush(), 2)
+        self.assertEqual((u1.last_seen, u2.last_seen), (later, later))
+        self.assertEqual(buffer.flush(), 0)
+
+    def test_notification_publish(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        subscription = self.app.notifier.subscribe(u.id)
+        u.add_notification('unread_message_count', 3)
+        self.assertIsNone(subscription.get(timeout=0.01))
+        db.session.commit()
+        event = subscription.get(timeout=0.01)
+        self.assertEqual((event['name'], event['data']), ('unread_message_count', 3))
+        subscription.close()
+
+    def test_unread_messages(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        for i in range(3):
+            db.session.add(Message(author=u1, recipient=u2, body=f'message {i}'))
+            self.assertEqual(u2.add_unread_message(), i + 1)
+            db.session.commit()
+        self.assertEqual(u2.new_messages(), 3)
+        self.assertEqual(User.repair_counters(), 0)
+
+        u2.read_messages()
+        db.session.commit()
+        self.assertEqual(u2.new_messages(), 0)
+        u2.unread_message_count = 7
+        db.session.commit()
+        self.assertEqual(User.repair_counters(), 1)
+        self.assertEqual(u2.new_messages(), 0)
+
+        # 同一事务中连续收到两条私信
+        for i in range(2):
+            db.session.add(Message(author=u1, recipient=u2, body=f'again {i}'))
+            self.assertEqual(u2.add_unread_message(), i + 1)
+        u2.adjust_counter('unread_message_count', 1)
+        self.assertEqual(u2.new_messages(), 3)
+        db.session.rollback()
+        self.assertEqual(u2.new_messages(), 0)
+
+    def test_search_outbox(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='first post', author=u)
+        p2 = Post(body='second post', author=u)
+        with mock.patch.object(self.app, 'redis') as redis, mock.patch.object(self.app, 'task_queue') as queue:
+            redis.set.side_effect = [True, False]
+            db.session.add_all([u, p1, p2])
+            db.session.flush()
+            p1.body = 'first post, edited'
+            db.session.commit()
+            db.session.delete(p2)
+            db.session.commit()
+        queue.enqueue.assert_called_once_with('app.tasks.index_search_outbox')
+        self.assertEqual([(row.object_id, row.operation) for row in SearchOutbox.query],
+                         [(p1.id, 'add'), (p2.id, 'add'), (p1.id, 'add'), (p2.id, 'delete')])
+        self.assertEqual(SearchOutbox.backlog()['pending'], 4)
+
+        # 失败时保留并推迟重试
+        with mock.patch('app.models.add_to_index', side_effect=ConnectionError):
+            self.assertRaises(ConnectionError, SearchOutbox.drain, 10)
+        self.assertEqual(SearchOutbox.drain(10), 0)
+        self.assertEqual({row.attempts for row in SearchOutbox.query}, {1})
+
+        SearchOutbox.query.update({'next_attempt': 0})
+        with mock.patch('app.models.add_to_index') as add, \
+                mock.patch('app.models.remove_from_index') as remove:
+            self.assertEqual(SearchOutbox.drain(10), 4)
+        add.assert_called_once_with('post', [p1])
+        remove.assert_called_once_with('post', [p2.id])
+        self.assertEqual(SearchOutbox.backlog(), {'pending': 0, 'lag': 0})
+
+        # 某一批失败时继续处理后面的批次，并按最早的重试时间安排任务
+        with mock.patch.object(SearchOutbox, 'schedule', return_value=True):
+            db.session.add_all([Post(body=f'post {i}', author=u) for i in range(3)])
+            db.session.commit()
+        with mock.patch('app.models.add_to_index', side_effect=[ConnectionError, None, None]), \
+                mock.patch('app.models.remove_from_index'):
+            self.assertEqual(SearchOutbox.drain_all(1), 2)
+        row = SearchOutbox.query.one()
+        self.assertEqual(row.attempts, 1)
+        with mock.patch.object(self.app, 'redis') as redis, mock.patch.object(self.app, 'task_queue') as queue:
+            redis.set.return_value = True
+            SearchOutbox.schedule_retry()
+        delay = queue.enqueue_in.call_args[0][0].total_seconds()
+        self.assertAlmostEqual(delay, row.next_attempt - time.time(), delta=1)
+        queue.enqueue_in.assert_called_once_with(mock.ANY, 'app.tasks.index_search_outbox')
+
+        # Redis不可用无法安排任务时，提交后直接处理
+        SearchOutbox.query.delete()
+        db.session.commit()
+        p3 = Post(body='third post', author=u)
+        with mock.patch('app.models.add_to_index') as add, mock.patch('app.models.remove_from_index'):
+            db.session.add(p3)
+            db.session.commit()
+        add.assert_called_once_with('post', [p3])
+        self.assertEqual(SearchOutbox.query.count(), 0)
+
+
+    def test_local_search(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='今天天气很好', author=u)
+        p2 = Post(body='The weather is nice today', author=u)
+        p3 = Post(body='天气预报说明天下雨, weather is bad', author=u)
+        p4 = Post(body='用Python写代码hello世界', author=u)
+        db.session.add_all([u, p1, p2, p3, p4])
+        db.session.commit()
+        while SearchOutbox.drain(10):
+            pass
+
+        self.assertEqual(Post.search('天气', 1, 10)[1], 2)
+        self.assertEqual(set(Post.search('天气', 1, 10)[0]), {p1, p3})
+        self.assertEqual(set(Post.search('Weather', 1, 10)[0]), {p2, p3})
+        self.assertEqual(Post.search('雨', 1, 10)[0].all(), [p3])
+        self.assertEqual(Post.search('snow', 1, 10)[1], 0)
+        # 中英文之间没有空格也按文字切分
+        self.assertEqual(Post.search('代码', 1, 10)[0].all(), [p4])
+        self.assertEqual(Post.search('世界', 1, 10)[0].all(), [p4])
+        self.assertEqual(Post.search('python', 1, 10)[0].all(), [p4])
+        self.assertEqual(tokenize('hello世界'), ['hello', '世', '界', '世界'])
+
+        db.session.delete(p3)
+        db.session.commit()
+        while SearchOutbox.drain(10):
+            pass
+        self.assertEqual(Post.search('天气', 1, 10)[0].all(), [p1])
+
+
+    def test_reindex(self):
+        u = User(username='john', email='john@example.com')
+        posts = [Post(body=f'post {i} weather', author=u) for i in range(7)]
+        with mock.patch.object(SearchOutbox, 'schedule', return_value=True):
+            db.session.add_all([u] + posts)
+            db.session.commit()
+        SearchOutbox.query.delete()
+        db.session.commit()
+        self.assertEqual(Post.search('weather', 1, 10)[1], 0)
+
+        backend = self.app.search
+        target = backend.create_index('post', Post.__searchable__)
+        progress = []
+        done = Post.reindex(target, after=posts[1].id, chunk_size=2, workers=2,
+                            on_progress=lambda last_id, done: progress.append((last_id, done)))
+        self.assertEqual(done, 5)
+        self.assertEqual(progress[-1], (posts[-1].id, 5))
+        self.assertEqual([last_id for last_id, _ in progress], sorted(last_id for last_id, _ in progress))
+        # 切换别名之前查询仍然使用原来的索引
+        self.assertEqual(Post.search('weather', 1, 10)[1], 0)
+        self.assertEqual(backend.rebuild_target('post'), target)
+        # 重建期间的修改和删除同时写入新索引
+        posts[2].body = 'post 2 sunny'
+        db.session.delete(posts[3])
+        db.session.commit()
+        SearchOutbox.drain(10)
+        switch_index('post', target)
+        self.assertIsNone(backend.rebuild_target('post'))
+        result, total = Post.search('weather', 1, 10)
+        self.assertEqual((set(result), total), (set(posts[4:]), 3))
+        self.assertEqual(Post.search('sunny', 1, 10)[0].all(), [posts[2]])
+
+    def test_search_order_and_cache(self):
+        u = User(username='john', email='john@example.com')
+        p1, p2, p3 = [Post(body=f'post {i}', author=u) for i in range(3)]
+        with mock.patch.object(SearchOutbox, 'schedule', return_value=True):
+            db.session.add_all([u, p1, p2, p3])
+            db.session.commit()
+
+        with mock.patch.object(self.app.search, 'query', return_value=([p2.id, p3.id, p1.id], 3)) as query:
+            # 按相关度顺序返回，第二页从缓存中切片
+            self.assertEqual(Post.search('Post ', 1, 2)[0].all(), [p2, p3])
+            self.assertEqual(Post.search(' post', 2, 2)[0].all(), [p1])
+            self.assertEqual(query.call_count, 1)
+            posts, total = Post.search('post', 3, 2)
+            self.assertEqual((posts.all(), total), ([], 3))
+            self.assertEqual(query.call_count, 1)
+            # 写入索引后缓存失效
+            while SearchOutbox.drain(10):
+                pass
+            Post.search('post', 1, 2)
+            self.assertEqual(query.call_count, 2)
+
+    def test_translation_cache(self):
+        self.app.config.update(BDAPPID='appid', BDKEY='key')
+        with TranslateStub() as stub, self.app.test_request_context():
+            self.app.translator.url = stub.url
+            self.assertEqual(translate('你好', 'zh', 'en'), '[en] 你好')
+            self.assertEqual(translate('你好', 'zh', 'en'), '[en] 你好')
+            self.assertEqual(len(stub.requests), 1)
+            stub.error = 'Invalid Access Limit'
+            translate('你好', 'zh', 'jp')
+            translate('你好', 'zh', 'jp')
+            self.assertEqual(len(stub.requests), 3)
+        self.assertEqual(self.app.translation_cache.stats['miss'], 3)
+        self.assertEqual(self.app.translation_cache.stats['local'], 1)
+
+    def test_translate_batch(self):
+        self.app.config.update(BDAPPID='appid', BDKEY='key', LOGIN_DISABLED=True)
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='你好', author=u, language='zh')
+        p2 = Post(body='第一行\n第二行', author=u, language='zh')
+        p3 = Post(body='こんにちは', author=u, language='ja')
+        db.session.add_all([u, p1, p2, p3])
+        db.session.commit()
+        client = self.app.test_client()
+        with TranslateStub() as stub:
+            self.app.translator.url = stub.url
+            items = [{'post_id': p.id, 'dest_language': 'en'} for p in (p1, p2, p3, p1)]
+            response = client.post('/translate/batch', json={'items': items + [{'post_id': 0, 'dest_language': 'en'}]})
+            self.assertEqual([t['text'] for t in response.get_json()['translations']],
+                             ['[en] 你好', '[en] 第一行\n[en] 第二行', '[en] こんにちは', '[en] 你好'])
+            # 相同语言的文本合并请求，多行文本单独请求
+            self.assertEqual(sorted((r['from'], r['q']) for r in stub.requests),
+                             [('jp', 'こんにちは'), ('zh', '你好'), ('zh', '第一行\n第二行')])
+
+            # 连续失败后断开，不再请求翻译服务
+            stub.status = 500
+            for i in range(self.app.config['TRANSLATE_BREAKER_THRESHOLD'] + 2):
+                with self.app.test_request_context():
+                    self.assertTrue(translate(f'text {i}', 'zh', 'en').startswith('Error'))
+            self.assertEqual(len(stub.requests), 3 + self.app.config['TRANSLATE_BREAKER_THRESHOLD'])
+
+
+    def test_detect_language(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='今天天气很好，我们一起去公园散步吧', author=u)
+        p2 = Post(body='The weather is nice today, let us go for a walk', author=u)
+        p3 = Post(body='short', author=u)
+        p4 = Post(body='Ceci est un message en français', author=u, language='fr')
+        db.session.add_all([u, p1, p2, p3, p4])
+        db.session.commit()
+        SearchOutbox.query.delete()
+        db.session.commit()
+
+        # Redis不可用时直接识别
+        Post.schedule_language_detection([p1.id, p2.id, p3.id, p4.id])
+        db.session.expire_all()
+        self.assertEqual([p.language for p in (p1, p2, p3, p4)], ['zh', 'en', '', 'fr'])
+        self.assertEqual(SearchOutbox.query.count(), 0)
+        cli.register(self.app)
+        result = self.app.test_cli_runner().invoke(args=['posts', 'detect-language'])
+        self.assertIn('0 posts updated', result.output)
+
+    def test_export_posts(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        now = datetime.utcnow()
+        db.session.add_all([u1, u2] + [Post(body=f'post {i}', author=u1, time_stamp=now + timedelta(seconds=i))
+                                       for i in range(5)])
+        db.session.commit()
+        self.assertEqual([post['body'] for post in u1.export_posts(batch_size=2)], [f'post {i}' for i in range(5)])
+
+        with tempfile.TemporaryDirectory() as folder:
+            self.app.config['EXPORT_FOLDER'] = folder
+            with gzip.open(os.path.join(folder, 'posts.ndjson.gz'), 'wt') as f:
+                f.write('{}\n')
+            token = u1.get_export_token('posts.ndjson.gz')
+            self.assertEqual(u1.verify_export_token(token), 'posts.ndjson.gz')
+            self.assertIsNone(u2.verify_export_token(token))
+            self.assertIsNone(u1.verify_export_token(u1.get_export_token('posts.ndjson.gz', -10)))
+            client = self.app.test_client()
+            with client.session_transaction() as session:
+                session['_user_id'] = str(u1.id)
+            response = client.get(f'/export_posts/{token}')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(gzip.decompress(response.data), b'{}\n')
+            response.close()
+            with client.session_transaction() as session:
+                session['_user_id'] = str(u2.id)
+            self.assertEqual(client.get(f'/export_posts/{token}').status_code, 404)
+
+            old = os.path.join(folder, 'posts-1-old.ndjson.gz')
+            open(old, 'w').close()
+            expired = time.time() - self.app.config['EXPORT_LINK_EXPIRES'] - 1
+            os.utime(old, (expired, expired))
+            self.assertEqual(User.remove_expired_exports(), 1)
+            self.assertEqual(os.listdir(folder), ['posts.ndjson.gz'])
+
+    def test_task_progress(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([u, Task(id='job1', name='export_posts', user=u)])
+        db.session.commit()
+        job = mock.Mock(meta={})
+        job.get_id.return_value = 'job1'
+        progress = TaskProgress(job)
+        reported = [i for i in range(101) if progress.update(i)]
+        self.assertEqual(reported, list(range(0, 101, self.app.config['TASK_PROGRESS_STEP'])))
+        self.assertEqual(job.save_meta.call_count, len(reported))
+        self.assertEqual([n.get_data() for n in u.notifications], [{'task_id': 'job1', 'progress': 100}])
+        self.assertTrue(Task.query.get('job1').complete)
+
+        progress.fail()
+        self.assertTrue(job.meta['failed'])
+        self.assertEqual([n.get_data() for n in u.notifications],
+                         [{'task_id': 'job1', 'progress': 100, 'failed': True}])
+
+    def test_tasks_progress(self):
+        u = User(username='john', email='john@example.com')
+        t1, t2, t3 = [Task(id=f'job{i}', name='export_posts', user=u) for i in range(1, 4)]
+        t3.complete = True
+        db.session.add_all([u, t1, t2, t3])
+        db.session.commit()
+        job = mock.Mock(meta={'progress': 40})
+        with mock.patch('rq.job.Job.fetch_many', return_value=[job, None]) as fetch_many:
+            self.assertEqual(u.get_tasks_progress(), [(t1, 40)])
+            self.assertEqual(fetch_many.call_args[0][0], ['job1', 'job2'])
+        self.assertTrue(Task.query.get('job2').complete)
+        self.assertEqual(u.get_tasks_in_progress(), [t1])
+
+    def test_mailer(self):
+        mailer = self.app.mailer
+        mailer.backoff, mailer.interval = 0.01, 0
+        with SMTPStub() as stub, self.app.test_request_context():
+            state = self.app.extensions['mail']
+            state.suppress, state.use_ssl, state.server, state.port = False, False, *stub.server_address
+            stub.fail_next = 2
+            for i in range(5):
+                send_email('hello', sender='admin@example.com', recipients=[f'user{i}@example.com'],
+                           text_body='hello', html_body='<p>hello</p>')
+            mailer.join()
+            self.assertEqual(len(stub.messages), 5)
+            self.assertLess(stub.connections, 5 + 2)
+
+            # 超过重试次数后放弃
+            stub.fail_next = self.app.config['MAIL_MAX_RETRIES']
+            with mock.patch.object(self.app.logger, 'error') as error:
+                send_email('hello', sender='admin@example.com', recipients=['user@example.com'],
+                           text_body='hello', html_body='<p>hello</p>')
+                mailer.join()
+            self.assertEqual(len(stub.messages), 5)
+            error.assert_called_once()
+
+            # 邮件本身有问题时记录后丢弃，同一批的其他邮件照常发送
+            with mock.patch.object(self.app.logger, 'exception') as exception:
+                send_email('hello\nBcc: x@example.com', sender='admin@example.com',
+                           recipients=['bad@example.com'], text_body='hello', html_body='<p>hello</p>')
+                send_email('hello', sender='admin@example.com', recipients=['user5@example.com'],
+                           text_body='hello', html_body='<p>hello</p>')
+                mailer.join()
+            self.assertEqual(len(stub.messages), 6)
+            exception.assert_called_once()
+            self.assertTrue(mailer.thread.is_alive())
+
+    def test_following_ids(self):
+        users = [User(username=f'user{i}', email=f'user{i}@example.com') for i in range(4)]
+        db.session.add_all(users)
+        users[0].follow(users[1])
+        users[0].follow(users[3])
+        users[2].follow(users[0])
+        self.assertTrue(users[0].is_following(users[1]))
+        db.session.commit()
+        self.assertEqual(users[0].following_ids(users), {users[1].id, users[3].id})
+        self.assertEqual(users[0].following_ids([]), set())
+        users[0].follow(users[1])
+        db.session.commit()
+        self.assertEqual(users[0].followed_count, 2)
+
+    def test_suggestions(self):
+        u1, u2, u3, u4, u5, u6 = users = [User(username=f'user{i}', email=f'user{i}@example.com')
+                                          for i in range(1, 7)]
+        db.session.add_all(users + [Post(body='hello', author=u5)])
+        for follower, followed in ((u1, u2), (u1, u3), (u2, u4), (u3, u4), (u3, u5), (u4, u6), (u6, u1)):
+            follower.follow(followed)
+        db.session.commit()
+
+        # u4有两个共同关注，u5只有一个但最近发表过
+        self.assertEqual(u1.who_to_follow(), [u4, u5])
+        # 关注后增量调整：u4不再推荐，u4关注的u6成为u1的候选，u4成为u1的粉丝u6的候选
+        u1.follow(u4)
+        db.session.commit()
+        u6.who_to_follow()
+        self.assertEqual(u1.who_to_follow(), [u5, u6])
+        incremental = {u.id: self.app.suggestions.memory_backend.top(u.id, 10) for u in users}
+        self.app.suggestions.refresh()
+        refreshed = {u.id: self.app.suggestions.memory_backend.top(u.id, 10) for u in users}
+        self.assertEqual(incremental[u1.id], refreshed[u1.id])
+        u1.unfollow(u3)
+        db.session.commit()
+        self.assertEqual(u1.who_to_follow(), [u6])
+
+        token = u1.get_token()
+        db.session.commit()
+        client = self.app.test_client()
+        headers = {'Authorization': f'Bearer {token}'}
+        response = client.get(f'/api/users/{u1.id}/suggestions', headers=headers)
+        self.assertEqual([item['username'] for item in response.get_json()['items']], ['user6'])
+        self.assertEqual(client.get(f'/api/users/{u2.id}/suggestions', headers=headers).status_code, 403)
+
+        # 没有候选的用户也记为已计算，不会每次读取都重新计算
+        suggestions = self.app.suggestions
+        suggestions.redis_backend = RedisSuggestionBackend(RedisStub(), suggestions.size, 60)
+        lonely = User(username='lonely', email='lonely@example.com')
+        db.session.add(lonely)
+        db.session.commit()
+        with mock.patch.object(suggestions, 'rebuild', wraps=suggestions.rebuild) as rebuild:
+            self.assertEqual(lonely.who_to_follow(), [])
+            self.assertEqual(lonely.who_to_follow(), [])
+        self.assertEqual(rebuild.call_count, 1)
+        # 关注后标记失效，下次读取重新计算
+        lonely.follow(u1)
+        db.session.commit()
+        self.assertFalse(suggestions.redis_backend.exists(lonely.id))
+        self.assertEqual(set(lonely.who_to_follow()), {u2, u4})
+
+        # 进程内实现只保存最近使用的用户
+        memory = MemorySuggestionBackend(10, 2)
+        memory.replace_many({1: {3: 1}, 2: {3: 1}})
+        memory.top(1, 10)
+        memory.replace_many({4: {}})
+        memory.adjust([(2, 5), (4, 5)], 1)
+        self.assertEqual((memory.exists(1), memory.exists(2), memory.exists(4)), (True, False, True))
+        self.assertEqual(memory.top(4, 10), [5])
+
+    def test_bulk_follow_api(self):
+        users = [User(username=f'user{i}', email=f'user{i}@example.com') for i in range(5)]
+        db.session.add_all(users)
+        users[0].follow(users[1])
+        token = users[0].get_token()
+        db.session.commit()
+        client = self.app.test_client()
+        headers = {'Authorization': f'Bearer {token}'}
+        ids = [u.id for u in users]
+
+        response = client.get(f'/api/users?ids={ids[3]},{ids[1]},999', headers=headers)
+        self.assertEqual([(item['id'], item['is_following']) for item in response.get_json()['items']],
+                         [(ids[3], False), (ids[1], True)])
+
+        statements = []
+        db.event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+        response = client.post(f'/api/users/{ids[0]}/followed', headers=headers, json={'ids': ids})
+        self.assertEqual([item['id'] for item in response.get_json()['items']], ids[2:])
+        self.assertEqual(len([s for s in statements if s.startswith('INSERT INTO followers')]), 1)
+        self.assertEqual(users[0].following_ids(users), set(ids[1:]))
+        self.assertEqual((users[0].followed_count, users[3].follower_count), (4, 1))
+
+        response = client.delete(f'/api/users/{ids[0]}/followed?ids={ids[1]},{ids[2]}', headers=headers)
+        self.assertEqual([item['id'] for item in response.get_json()['items']], ids[1:3])
+        self.assertEqual(users[0].following_ids(users), set(ids[3:]))
+        self.assertEqual((users[0].followed_count, users[1].follower_count), (2, 0))
+
+        self.assertEqual(client.post(f'/api/users/{ids[0]}/followed', headers=headers,
+                                     json={'ids': [999]}).status_code, 400)
+        self.assertEqual(client.post(f'/api/users/{ids[1]}/followed', headers=headers,
+                                     json={'ids': [ids[2]]}).status_code, 403)
+        self.assertEqual(User.repair_counters(), 0)
+
+    def test_posts_api(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        u2.follow(u1)
+        token1, token2 = u1.get_token(), u2.get_token()
+        db.session.commit()
+        client = self.app.test_client()
+        headers = {'Authorization': f'Bearer {token1}'}
+
+        response = client.post('/api/posts', headers=headers, json={'body': 'hello world'})
+        self.assertEqual(response.status_code, 201)
+        post = response.get_json()
+        self.assertEqual(post['author']['username'], 'john')
+        self.assertEqual(client.get(response.headers['Location'], headers=headers).get_json(), post)
+        self.assertEqual(client.post('/api/posts', headers=headers, json={'body': 'x' * 141}).status_code, 400)
+
+        response = client.post('/api/posts/batch', headers=headers,
+                               json={'posts': [{'body': f'post {i}'} for i in range(4)]})
+        self.assertEqual(len(response.get_json()['items']), 4)
+        self.assertEqual(client.post('/api/posts/batch', headers=headers,
+                                     json={'posts': [{'body': 'ok'}, {}]}).status_code, 400)
+        self.assertEqual(Post.query.count(), 5)
+
+        statements = []
+        db.event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+        data = client.get(f'/api/users/{u1.id}/posts?per_page=3', headers=headers).get_json()
+        self.assertEqual([item['body'] for item in data['items']], ['post 3', 'post 2', 'post 1'])
+        self.assertEqual(len([s for s in statements if 'FROM post' in s]), 1)
+        data = client.get(data['_links']['next'], headers=headers).get_json()
+        self.assertEqual([item['body'] for item in data['items']], ['post 0', 'hello world'])
+        self.assertIsNone(data['_links']['next'])
+
+        headers = {'Authorization': f'Bearer {token2}'}
+        data = client.get('/api/timeline?per_page=2', headers=headers).get_json()
+        self.assertEqual([item['body'] for item in data['items']], ['post 3', 'post 2'])
+        data = client.get(data['_links']['next'], headers=headers).get_json()
+        self.assertEqual([item['body'] for item in data['items']], ['post 1', 'post 0'])
+        self.assertEqual(client.get('/api/timeline?cursor=bad', headers=headers).status_code, 400)
+        # 伪造的游标中类型不符的值返回400而不是带进SQL
+        for url, values in [('/api/users', ['next', {'a': 1}]), ('/api/users', ['next', True]),
+                            ('/api/posts', ['next', '2020-01-01', []]),
+                            ('/api/posts', ['next', 20200101, 1]),
+                            ('/api/timeline', ['next', '2020-01-01', '1'])]:
+            cursor = base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('utf-8')
+            self.assertEqual(client.get(f'{url}?cursor={cursor}', headers=headers).status_code, 400)
+
+    def test_import(self):
+        db.session.add(User(username='john', email='john@example.com'))
+        db.session.commit()
+        cli.register(self.app)
+        runner = self.app.test_cli_runner()
+        with tempfile.TemporaryDirectory() as folder:
+            users = os.path.join(folder, 'users.ndjson')
+            with open(users, 'w') as f:
+                for record in [{'username': 'susan', 'email': 'susan@example.com', 'password': 'cat'},
+                               {'username': 'john', 'email': 'other@example.com'},
+                               {'username': 'susan', 'email': 'susan2@example.com'},
+                               {'username': 'david', 'email': 'david@example.com', 'password': 'dog'}]:
+                    f.write(json.dumps(record) + '\n')
+                f.write('not json\n')
+            posts = os.path.join(folder, 'posts.csv')
+            with open(posts, 'w') as f:
+                f.write('author,body,time_stamp\nsusan,hello,2021-01-01T00:00:00Z\n'
+                        'david,world,\nnobody,lost,\ndavid,again,2021-01-01T09:00:00+08:00\n')
+            follows = os.path.join(folder, 'follows.csv')
+            with open(follows, 'w') as f:
+                f.write('follower,followed\njohn,susan\njohn,david\njohn,susan\njohn,john\n')
+
+            result = runner.invoke(args=['import', 'users', users, '--batch-size', '2', '--workers', '2'])
+            self.assertIn('2 users imported, 3 skipped', result.output)
+            result = runner.invoke(args=['import', 'posts', posts])
+            self.assertIn('3 posts imported, 1 skipped', result.output)
+            result = runner.invoke(args=['import', 'follows', follows])
+            self.assertIn('2 follows imported, 2 skipped', result.output)
+
+        susan = User.query.filter_by(username='susan').first()
+        self.assertTrue(susan.check_password('cat'))
+        self.assertIsNone(User.query.filter_by(email='other@example.com').first())
+        self.assertEqual(Post.query.filter_by(author=susan).one().time_stamp, datetime(2021, 1, 1))
+        self.assertEqual(Post.query.filter_by(body='again').one().time_stamp, datetime(2021, 1, 1, 1))
+        # 测试中Redis不可用，导入后直接写入索引
+        self.assertEqual(SearchOutbox.query.count(), 0)
+        self.assertEqual(Post.search('again', 1, 10)[0].one().body, 'again')
+        john = User.query.filter_by(username='john').first()
+        self.assertEqual([post.body for post in john.followed_posts()], ['world', 'again', 'hello'])
+        self.assertEqual((john.followed_count, susan.follower_count, susan.post_count), (2, 1, 1))
+        self.assertEqual(User.repair_counters(), 0)
+
+    def test_password_hasher(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        u.password_hash = generate_password_hash('cat', 'pbkdf2:sha256:1000')
+        db.session.commit()
+        token = base64.b64encode(b'john:cat').decode()
+        client = self.app.test_client()
+        response = client.post('/api/tokens', headers={'Authorization': f'Basic {token}'})
+        self.assertEqual(response.status_code, 200)
+        # 旧的迭代次数在校验成功后按配置重新计算
+        self.assertTrue(u.password_hash.startswith(self.app.config['PASSWORD_HASH_METHOD'] + '$'))
+
+        hasher = self.app.password_hasher
+        # 校验成功后短时间内不再计算哈希
+        with mock.patch('app.passwords.check_password_hash', side_effect=AssertionError):
+            self.assertTrue(u.check_password('cat'))
+        self.assertFalse(u.check_password('dog'))
+        u.set_password('dog')
+        self.assertFalse(u.check_password('cat'))
+        self.assertTrue(u.check_password('dog'))
+
+        hasher.slots.acquire()
+        self.app.config['PASSWORD_HASH_QUEUE_SIZE'] = 1
+        hasher.init_app(self.app)
+        hasher.slots.acquire()
+        with self.assertRaises(PasswordHasherBusy):
+            hasher.hash('cat')
+        self.app.credential_cache.local.clear()
+        response = client.post('/api/tokens', headers={'Authorization': 'Basic ' + base64.b64encode(
+            b'john:dog').decode()})
+        self.assertEqual(response.status_code, 503)
+        hasher.slots.release()
+
+        pool = PasswordHasher()
+        self.app.config['PASSWORD_HASH_WORKERS'] = 1
+        pool.init_app(self.app)
+        password_hash = pool.hash('cat')
+        self.assertTrue(pool.verify(u.id, password_hash, 'cat'))
+        self.assertFalse(pool.verify(u.id, password_hash, 'dog'))
+        pool.executor.shutdown()
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)